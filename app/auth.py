@@ -0,0 +1,167 @@
+"""
+Session tokens. /login issues per-user tokens; service tokens for the bulk endpoints carry a scope
+claim and are issued offline with the same signing key:
+
+    SESSION_SECRET=... python -m app.auth --service ops --scope admin --ttl-days 30
+"""
+import argparse
+import logging
+import os
+import secrets
+import threading
+import time
+
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+DEFAULT_TOKEN_TTL_SECONDS = 24 * 3600
+TOKEN_ALGORITHM = "HS256"
+# Scope of service tokens allowed on the bulk import/export/batch endpoints
+ADMIN_SCOPE = "admin"
+SERVICE_SUBJECT_PREFIX = "service:"
+
+
+class InvalidSession(Exception):
+    """A session token that is malformed, wrongly signed, expired or revoked."""
+
+
+class SessionTokens:
+    """
+    Issues and verifies HMAC-signed, expiring session tokens (JWT, HS256). Verification is entirely
+    in-process: no storage read per request. Password resets revoke a user's earlier tokens through
+    a per-user "issued before" cutoff kept in memory; cutoffs are dropped once every token they
+    could reject has expired. The list is per process, like the other in-process caches.
+    """
+
+    def __init__(self, secret: str = None, ttl_seconds: float = DEFAULT_TOKEN_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._revoked_before = {}
+        self.secret = secret
+        self.ttl_seconds = ttl_seconds
+        self.issued = 0
+        self.rejected = 0
+
+    def configure(self, secret: str = None, ttl_seconds: float = None):
+        if secret:
+            self.secret = secret
+        if ttl_seconds is not None:
+            self.ttl_seconds = float(ttl_seconds)
+        if not self.secret:
+            # Tokens then only verify in this process and until it restarts
+            logging.warning("SESSION_SECRET not set; using a random per-process session secret.")
+            self.secret = secrets.token_urlsafe(32)
+        logging.info(f"Session tokens configured: ttl_seconds={self.ttl_seconds}")
+
+    def issue(self, username: str) -> dict:
+        """Token response for /login."""
+        import jwt
+        if not self.secret:
+            self.configure()
+        now = time.time()
+        # iat keeps sub-second precision so a login right after a password reset is not revoked
+        token = jwt.encode({"sub": username, "iat": now, "exp": int(now + self.ttl_seconds)},
+                           self.secret, algorithm=TOKEN_ALGORITHM)
+        with self._lock:
+            self.issued += 1
+        return {"access_token": token, "token_type": "bearer", "expires_in": int(self.ttl_seconds)}
+
+    def issue_service(self, name: str, scopes, ttl_seconds: float) -> str:
+        """Token for a service (not a user) holding the given scopes, e.g. for bulk jobs."""
+        import jwt
+        if not self.secret:
+            self.configure()
+        now = time.time()
+        claims = {"sub": SERVICE_SUBJECT_PREFIX + name, "scope": " ".join(scopes), "iat": now,
+                  "exp": int(now + ttl_seconds)}
+        return jwt.encode(claims, self.secret, algorithm=TOKEN_ALGORITHM)
+
+    def verify(self, token: str) -> dict:
+        """Return the token's claims; raises InvalidSession."""
+        import jwt
+        if not self.secret:
+            self.configure()
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=[TOKEN_ALGORITHM], options={"require": ["sub", "iat", "exp"]})
+        except jwt.ExpiredSignatureError as e:
+            self._reject()
+            raise InvalidSession("Session expired") from e
+        except jwt.InvalidTokenError as e:
+            self._reject()
+            raise InvalidSession("Invalid session token") from e
+        with self._lock:
+            revoked_before = self._revoked_before.get(claims["sub"])
+        if revoked_before is not None and claims["iat"] <= revoked_before:
+            self._reject()
+            raise InvalidSession("Session revoked")
+        return claims
+
+    def revoke(self, username: str):
+        """Reject every token issued to the user until now (e.g. after a password change)."""
+        now = time.time()
+        with self._lock:
+            self._revoked_before[username] = now
+            expired = [u for u, cutoff in self._revoked_before.items() if cutoff < now - self.ttl_seconds]
+            for u in expired:
+                del self._revoked_before[u]
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "issued": self.issued,
+                "rejected": self.rejected,
+                "revoked_users": len(self._revoked_before),
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+
+sessions = SessionTokens()
+
+_bearer = HTTPBearer(auto_error=False)
+
+
+def _claims(credentials) -> dict:
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return sessions.verify(credentials.credentials)
+    except InvalidSession as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+
+
+async def require_user(username: str, credentials: HTTPAuthorizationCredentials = Depends(_bearer)) -> str:
+    """
+    Dependency for /{username} endpoints: the request must carry a valid bearer token for that user.
+    401 for a missing or invalid token, 403 for another user's or a service token. Async so
+    verification runs on the event loop instead of a threadpool hop.
+    """
+    claims = _claims(credentials)
+    if "scope" in claims or claims["sub"] != username:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user")
+    return username
+
+
+def require_scope(scope: str):
+    """Dependency factory for endpoints reserved to service tokens holding `scope` (403 otherwise)."""
+    async def dependency(credentials: HTTPAuthorizationCredentials = Depends(_bearer)) -> str:
+        claims = _claims(credentials)
+        if scope not in str(claims.get("scope", "")).split():
+            raise HTTPException(status_code=403, detail=f"Requires a service token with the {scope!r} scope")
+        return claims["sub"]
+    return dependency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Issue a service token signed with SESSION_SECRET.")
+    parser.add_argument("--service", required=True, help="Name recorded in the token subject.")
+    parser.add_argument("--scope", action="append", default=None, help=f"Scope to grant (default: {ADMIN_SCOPE}).")
+    parser.add_argument("--ttl-days", type=float, default=30)
+    args = parser.parse_args()
+    secret = os.environ.get("SESSION_SECRET")
+    if not secret:
+        parser.error("SESSION_SECRET must be set to the server's signing key.")
+    sessions.configure(secret=secret)
+    print(sessions.issue_service(args.service, args.scope or [ADMIN_SCOPE], args.ttl_days * 86400))
@@ -0,0 +1,312 @@
+"""
+Walk-forward backtesting of next-date predictions. Every user's history is replayed in order: each
+cycle start after the first `min_history` dates is predicted from the dates before it, and the
+error is the predicted minus the actual interval in days. Models are evaluated side by side on the
+same predictions, so window sizes or alternative estimators can be compared before changing
+predict_next_dates:
+
+    window:W   rounded mean of the last W intervals (window:3 is predict_next_dates' next_date)
+    median:W   rounded median of the last W intervals
+    ewma:A     rounded exponentially weighted mean of all intervals with smoothing factor A
+
+Users are processed in chunks, padded to a users x intervals matrix so each model is vectorized over
+the whole chunk, and chunks are spread across a process pool. Histories come from storage or are
+generated (--synthetic N). With --feedback the logged predicted-vs-actual dates in
+prediction_feedback are scored as well.
+
+Usage: python -m app.backtest [--synthetic 100000] [--models window:3,window:6,ewma:0.3]
+                              [--tolerance 2] [--workers 8] [--feedback] [--output report.json]
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from app.cycle_store import CycleHistory, to_day
+from app.model import to_ragged_days
+
+DEFAULT_MODELS = ("window:3", "window:6", "median:5", "ewma:0.3")
+# Predictions within this many days of the actual date count as hits
+DEFAULT_TOLERANCE_DAYS = 2
+# Dates a prefix needs before it is used to predict the next one
+DEFAULT_MIN_HISTORY = 2
+# Users per process-pool task
+BACKTEST_CHUNK_USERS = 5000
+# Absolute errors are histogrammed up to this many days (larger errors share the last bin)
+MAX_ERROR_DAYS = 120
+MODEL_KINDS = ("window", "median", "ewma")
+
+
+def parse_model(spec: str):
+    """Return (kind, parameter) for a model spec such as "window:3"; raises ValueError otherwise."""
+    kind, _, param = spec.partition(":")
+    if kind not in MODEL_KINDS:
+        raise ValueError(f"Unknown model {spec!r}; expected one of {', '.join(k + ':...' for k in MODEL_KINDS)}")
+    try:
+        value = float(param) if kind == "ewma" else int(param)
+    except ValueError as e:
+        raise ValueError(f"Invalid parameter in model {spec!r}") from e
+    if (kind == "ewma" and not 0 < value <= 1) or (kind != "ewma" and value < 1):
+        raise ValueError(f"Out of range parameter in model {spec!r}")
+    return kind, value
+
+
+def _interval_matrix(values, offsets):
+    """Pack a ragged day array into (intervals, lengths): a NaN-padded users x intervals matrix."""
+    lengths = np.maximum(np.diff(offsets) - 1, 0)
+    width = int(lengths.max()) if len(lengths) else 0
+    matrix = np.full((len(lengths), width), np.nan)
+    if width:
+        diffs = np.diff(values).astype(np.float64)
+        # Drop the differences that straddle two users
+        keep = np.ones(len(diffs), dtype=bool)
+        boundaries = offsets[1:-1] - 1
+        keep[boundaries[(boundaries >= 0) & (boundaries < len(diffs))]] = False
+        matrix[np.arange(width) < lengths[:, None]] = diffs[keep]
+    return matrix, lengths
+
+
+def _predicted_intervals(matrix, kind: str, param):
+    """Predicted interval for column k (k >= 1) of every row from columns [0, k); column 0 is NaN."""
+    rows, width = matrix.shape
+    predicted = np.full((rows, width), np.nan)
+    if width < 2:
+        return predicted
+    ks = np.arange(1, width)
+    if kind == "window":
+        prefix = np.zeros((rows, width + 1))
+        np.cumsum(np.nan_to_num(matrix), axis=1, out=prefix[:, 1:])
+        lo = np.maximum(ks - param, 0)
+        predicted[:, 1:] = (prefix[:, ks] - prefix[:, lo]) / np.minimum(ks, param)
+    elif kind == "median":
+        padded = np.concatenate([np.full((rows, param - 1), np.nan), matrix], axis=1)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, param, axis=1)[:, :width - 1]
+        with warnings.catch_warnings():
+            # All-NaN windows only occur in the padding
+            warnings.simplefilter("ignore", RuntimeWarning)
+            predicted[:, 1:] = np.nanmedian(windows, axis=2)
+    else:
+        mean = matrix[:, 0].copy()
+        for k in range(1, width):
+            predicted[:, k] = mean
+            mean += param * (matrix[:, k] - mean)
+    return np.rint(predicted)
+
+
+def _empty_totals():
+    return {"predictions": 0, "abs_error_sum": 0.0, "error_sum": 0.0, "hits": 0,
+            "histogram": np.zeros(MAX_ERROR_DAYS + 1, dtype=np.int64)}
+
+
+def _add_errors(totals: dict, errors, tolerance: int):
+    abs_errors = np.abs(errors)
+    totals["predictions"] += len(errors)
+    totals["abs_error_sum"] += float(abs_errors.sum())
+    totals["error_sum"] += float(errors.sum())
+    totals["hits"] += int((abs_errors <= tolerance).sum())
+    totals["histogram"] += np.bincount(np.minimum(abs_errors, MAX_ERROR_DAYS).astype(np.int64),
+                                       minlength=MAX_ERROR_DAYS + 1)
+
+
+def backtest_chunk(values, offsets, models, tolerance: int = DEFAULT_TOLERANCE_DAYS,
+                   min_history: int = DEFAULT_MIN_HISTORY) -> dict:
+    """Error totals per model for one ragged chunk of sorted histories (see to_ragged_days)."""
+    matrix, lengths = _interval_matrix(np.asarray(values, dtype=np.int64), np.asarray(offsets, dtype=np.int64))
+    # Column k predicts interval k (the date at index k + 1) from the k intervals before it
+    columns = np.arange(matrix.shape[1])
+    targets = (columns < lengths[:, None]) & (columns >= max(min_history - 1, 1))
+    actual = matrix[targets]
+    results = {"users": len(lengths)}
+    for spec in models:
+        totals = _empty_totals()
+        _add_errors(totals, _predicted_intervals(matrix, *parse_model(spec))[targets] - actual, tolerance)
+        results[spec] = totals
+    return results
+
+
+def _merge(total: dict, part: dict, models):
+    total["users"] += part["users"]
+    for spec in models:
+        for key, value in part[spec].items():
+            total[spec][key] = total[spec][key] + value
+
+
+def _percentile(histogram, q: float):
+    cumulative = np.cumsum(histogram)
+    if not cumulative[-1]:
+        return None
+    return int(np.searchsorted(cumulative, q * cumulative[-1]))
+
+
+def summarize(totals: dict, tolerance: int) -> dict:
+    """MAE, hit rate, bias and error percentiles (days) from error totals."""
+    n = totals["predictions"]
+    if not n:
+        return {"predictions": 0, "mae_days": None, "hit_rate": None, "bias_days": None,
+                "p50_abs_error_days": None, "p90_abs_error_days": None}
+    return {
+        "predictions": n,
+        "mae_days": round(totals["abs_error_sum"] / n, 4),
+        "hit_rate": round(totals["hits"] / n, 4),
+        "bias_days": round(totals["error_sum"] / n, 4),
+        "p50_abs_error_days": _percentile(totals["histogram"], 0.5),
+        "p90_abs_error_days": _percentile(totals["histogram"], 0.9),
+    }
+
+
+def _chunks_by_length(values, offsets, chunk_users: int):
+    """Split a ragged array into chunks of users with similar history lengths, to limit padding."""
+    lengths = np.diff(offsets)
+    order = np.argsort(lengths, kind="stable")
+    for start in range(0, len(order), chunk_users):
+        users = order[start:start + chunk_users]
+        chunk_lengths = lengths[users]
+        chunk_offsets = np.zeros(len(users) + 1, dtype=np.int64)
+        np.cumsum(chunk_lengths, out=chunk_offsets[1:])
+        index = np.repeat(offsets[users] - chunk_offsets[:-1], chunk_lengths) + np.arange(chunk_offsets[-1])
+        yield values[index], chunk_offsets
+
+
+def run_backtest(chunks, models=DEFAULT_MODELS, tolerance: int = DEFAULT_TOLERANCE_DAYS,
+                 min_history: int = DEFAULT_MIN_HISTORY, workers: int = None) -> dict:
+    """
+    Backtest an iterable of (values, offsets) chunks across a process pool (workers=1 runs inline).
+    Returns the report with one summary per model, ranked by MAE.
+    """
+    models = list(models)
+    for spec in models:
+        parse_model(spec)
+    started = time.monotonic()
+    total = {"users": 0, **{spec: _empty_totals() for spec in models}}
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for values, offsets in chunks:
+            _merge(total, backtest_chunk(values, offsets, models, tolerance, min_history), models)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for values, offsets in chunks:
+                # Bound the chunks held in memory while storage pages are still being read
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _merge(total, future.result(), models)
+                pending.add(pool.submit(backtest_chunk, values, offsets, models, tolerance, min_history))
+            for future in pending:
+                _merge(total, future.result(), models)
+    summaries = {spec: summarize(total[spec], tolerance) for spec in models}
+    seconds = time.monotonic() - started
+    return {
+        "users": total["users"],
+        "tolerance_days": tolerance,
+        "min_history": min_history,
+        "workers": workers,
+        "seconds": round(seconds, 3),
+        "models": summaries,
+        "ranking": sorted((s for s in models if summaries[s]["predictions"]), key=lambda s: summaries[s]["mae_days"]),
+    }
+
+
+def synthetic_histories(users: int, seed: int = 0, min_dates: int = 6, max_dates: int = 36):
+    """
+    Ragged (values, offsets) of synthetic cycle starts: per-user mean cycle length around 28.5 days
+    and per-user variability, with an occasional skipped (unrecorded) period.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_dates, max_dates + 1, size=users)
+    offsets = np.zeros(users + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    user_of = np.repeat(np.arange(users), lengths)
+    means = rng.normal(28.5, 2.0, size=users)
+    spreads = rng.uniform(0.5, 4.0, size=users)
+    intervals = np.rint(rng.normal(means[user_of], spreads[user_of])).clip(18, 60)
+    intervals[rng.random(len(intervals)) < 0.03] *= 2
+    # The first "interval" of each user is replaced by a random start date
+    intervals[offsets[:-1]] = rng.integers(to_day("2015-01-01"), to_day("2020-01-01"), size=users)
+    values = np.cumsum(intervals.astype(np.int64))
+    values -= np.repeat(np.concatenate([[0], values[offsets[1:-1] - 1]]), lengths)
+    return values, offsets
+
+
+def storage_chunks(chunk_users: int = BACKTEST_CHUNK_USERS, page_size: int = 500):
+    """Yield (values, offsets) chunks of every user's parsed history, paging through menstrual_data."""
+    from app.storage import cycle_dates, get_storage
+
+    storage = get_storage()
+    cursor = None
+    histories = []
+    while True:
+        items, cursor = storage.page_cycle_docs(cursor, page_size)
+        histories.extend(CycleHistory.from_dates(cycle_dates(data)) for _, data, _ in items)
+        if len(histories) >= chunk_users or (cursor is None and histories):
+            yield to_ragged_days(histories)
+            histories = []
+        if cursor is None:
+            return
+
+
+def feedback_accuracy(tolerance: int = DEFAULT_TOLERANCE_DAYS, page_size: int = 500) -> dict:
+    """Score the predicted_date/actual_date pairs logged in prediction_feedback."""
+    from app.storage import get_storage
+
+    storage = get_storage()
+    cursor = None
+    errors = []
+    skipped = 0
+    while True:
+        items, cursor = storage.page_feedback(cursor, page_size)
+        for _, data in items:
+            try:
+                errors.append(to_day(data["predicted_date"]) - to_day(data["actual_date"]))
+            except (KeyError, TypeError, ValueError):
+                skipped += 1
+        if cursor is None:
+            break
+    totals = _empty_totals()
+    if errors:
+        _add_errors(totals, np.asarray(errors, dtype=np.int64), tolerance)
+    return {**summarize(totals, tolerance), "skipped_entries": skipped}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser(description="Walk-forward backtest of next-date prediction models.")
+    parser.add_argument("--models", default=",".join(DEFAULT_MODELS),
+                        help="Comma-separated window:W, median:W and ewma:A specs.")
+    parser.add_argument("--tolerance", type=int, default=DEFAULT_TOLERANCE_DAYS, help="Hit window in +/- days.")
+    parser.add_argument("--min-history", type=int, default=DEFAULT_MIN_HISTORY)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-users", type=int, default=BACKTEST_CHUNK_USERS)
+    parser.add_argument("--synthetic", type=int, help="Backtest N synthetic users instead of stored histories.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--feedback", action="store_true", help="Also score logged prediction feedback.")
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    args = parser.parse_args()
+    models = [m.strip() for m in args.models.split(",") if m.strip()]
+    try:
+        for spec in models:
+            parse_model(spec)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.synthetic:
+        generated = time.monotonic()
+        values, offsets = synthetic_histories(args.synthetic, seed=args.seed)
+        logging.info(f"Generated {args.synthetic} synthetic users in {time.monotonic() - generated:.2f}s")
+        chunks = _chunks_by_length(values, offsets, args.chunk_users)
+    else:
+        chunks = storage_chunks(args.chunk_users)
+    report = run_backtest(chunks, models, args.tolerance, args.min_history, args.workers)
+    report["source"] = f"synthetic:{args.synthetic}" if args.synthetic else "storage"
+    if args.feedback:
+        report["feedback"] = feedback_accuracy(args.tolerance)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,249 @@
+"""
+Bulk import of (username, date) rows into menstrual_data, from NDJSON ({"username": ..., "date": ...}
+per line) or CSV (username,date with an optional header). Input is parsed line by line and buffered
+in chunks grouped by user; each user's dates are de-duplicated, sorted and appended with batched
+writes (up to 500 users per batch), with a bounded number of batches committing at once and
+failed batches retried. Safe to re-run: dates already present are not added twice.
+
+Usage: python -m app.bulk_import rows.ndjson [--format csv] [--concurrency 8] [--chunk-rows 100000]
+       (use "-" to read from stdin)
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import json
+import logging
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.cycle_store import from_day, to_day
+from app.firebase_service import _invalidate_user
+from app.storage import get_storage
+
+# Users per batched write (Firestore allows at most 500 writes per batch)
+IMPORT_BATCH_SIZE = 500
+# Batched writes committing at the same time
+IMPORT_CONCURRENCY = 8
+# Rows buffered and grouped by user before their batches are committed
+IMPORT_CHUNK_ROWS = 100_000
+# Retries per failed batch, with exponential backoff starting at IMPORT_RETRY_BACKOFF_SECONDS
+IMPORT_RETRIES = 3
+IMPORT_RETRY_BACKOFF_SECONDS = 0.5
+# Failures kept in the report
+MAX_REPORTED_FAILURES = 100
+
+FORMATS = ("ndjson", "csv")
+
+
+def parse_row(line: str, fmt: str):
+    """
+    Return (username, day) for a data row, or None for blank lines and a CSV header.
+    Raises ValueError for rows that cannot be imported.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        if fmt == "ndjson":
+            row = json.loads(line)
+            username, value = row.get("username"), row.get("date")
+        else:
+            fields = next(csv.reader([line]))
+            if fields[0].strip().lower() == "username":
+                return None
+            username, value = fields[0].strip(), fields[1].strip()
+        if not username or not isinstance(username, str):
+            raise ValueError("missing username")
+        return username, to_day(value)
+    except (TypeError, AttributeError, IndexError) as e:
+        raise ValueError(f"invalid row {line[:80]!r}") from e
+
+
+class _Importer:
+    """Shared buffering and bookkeeping of the sync and async import paths."""
+
+    def __init__(self, fmt: str, batch_size: int, chunk_rows: int):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown import format {fmt!r}; expected one of {FORMATS}")
+        self.fmt = fmt
+        self.batch_size = max(1, min(batch_size, IMPORT_BATCH_SIZE))
+        self.chunk_rows = chunk_rows
+        self.buffer = defaultdict(set)
+        self.buffered_rows = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {
+            "rows": 0, "imported_rows": 0, "invalid_rows": 0, "user_writes": 0,
+            "batches": 0, "retried_batches": 0, "failed_batches": 0, "failures": [],
+        }
+
+    def add(self, line: str) -> bool:
+        """Buffer one input line; returns True when the buffer should be flushed."""
+        try:
+            row = parse_row(line, self.fmt)
+        except ValueError:
+            self.stats["rows"] += 1
+            self.stats["invalid_rows"] += 1
+            return False
+        if row is None:
+            return False
+        self.stats["rows"] += 1
+        username, day = row
+        self.buffer[username].add(day)
+        self.buffered_rows += 1
+        return self.buffered_rows >= self.chunk_rows
+
+    def take_batches(self):
+        """Drain the buffer into batches of {username: sorted ISO dates}."""
+        users = list(self.buffer.items())
+        self.buffer = defaultdict(set)
+        self.buffered_rows = 0
+        for start in range(0, len(users), self.batch_size):
+            yield {username: [from_day(d).isoformat() for d in sorted(days)]
+                   for username, days in users[start:start + self.batch_size]}
+
+    def record(self, batch: dict, attempts: int, error):
+        rows = sum(len(dates) for dates in batch.values())
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["retried_batches"] += attempts > 1
+            if error is None:
+                self.stats["imported_rows"] += rows
+                self.stats["user_writes"] += len(batch)
+                for username in batch:
+                    _invalidate_user(username)
+                return
+            self.stats["failed_batches"] += 1
+            if len(self.stats["failures"]) < MAX_REPORTED_FAILURES:
+                self.stats["failures"].append({
+                    "batch": self.stats["batches"], "users": len(batch), "rows": rows,
+                    "first_user": next(iter(batch)), "attempts": attempts, "error": str(error),
+                })
+            logging.error(f"Import batch of {len(batch)} users failed after {attempts} attempts: {error}")
+
+    def report(self) -> dict:
+        seconds = time.monotonic() - self.started
+        self.stats["seconds"] = round(seconds, 3)
+        self.stats["rows_per_sec"] = round(self.stats["rows"] / seconds, 1) if seconds else 0.0
+        logging.info("Bulk import finished: " + ", ".join(
+            f"{k}={v}" for k, v in self.stats.items() if k != "failures"))
+        return self.stats
+
+
+def _commit_with_retry(storage, batch: dict, retries: int):
+    for attempt in range(1, retries + 2):
+        try:
+            storage.append_cycle_dates_batch(batch)
+            return attempt, None
+        except Exception as e:
+            if attempt > retries:
+                return attempt, e
+            logging.warning(f"Import batch of {len(batch)} users failed (attempt {attempt}): {e}; retrying.")
+            time.sleep(IMPORT_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+
+async def _commit_with_retry_async(storage, batch: dict, retries: int):
+    for attempt in range(1, retries + 2):
+        try:
+            await storage.aappend_cycle_dates_batch(batch)
+            return attempt, None
+        except Exception as e:
+            if attempt > retries:
+                return attempt, e
+            logging.warning(f"Import batch of {len(batch)} users failed (attempt {attempt}): {e}; retrying.")
+            await asyncio.sleep(IMPORT_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+
+def import_lines(lines, fmt: str = "ndjson", batch_size: int = IMPORT_BATCH_SIZE,
+                 concurrency: int = IMPORT_CONCURRENCY, chunk_rows: int = IMPORT_CHUNK_ROWS,
+                 retries: int = IMPORT_RETRIES) -> dict:
+    """Import rows from an iterable of text lines (e.g. an open file). Returns the import report."""
+    importer = _Importer(fmt, batch_size, chunk_rows)
+    storage = get_storage()
+    # At most `concurrency` batches are in flight; parsing waits for a free slot
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def commit(batch):
+        try:
+            importer.record(batch, *_commit_with_retry(storage, batch, retries))
+        finally:
+            slots.release()
+
+    def flush(pool):
+        for batch in importer.take_batches():
+            slots.acquire()
+            pool.submit(commit, batch)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="import") as pool:
+        for line in lines:
+            if importer.add(line):
+                flush(pool)
+        flush(pool)
+    return importer.report()
+
+
+async def aiter_lines(chunks):
+    """Split an async stream of byte chunks (e.g. a request body) into decoded text lines."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def import_lines_async(lines, fmt: str = "ndjson", batch_size: int = IMPORT_BATCH_SIZE,
+                             concurrency: int = IMPORT_CONCURRENCY, chunk_rows: int = IMPORT_CHUNK_ROWS,
+                             retries: int = IMPORT_RETRIES) -> dict:
+    """Async import_lines for an async iterable of text lines (see aiter_lines)."""
+    importer = _Importer(fmt, batch_size, chunk_rows)
+    storage = get_storage()
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def commit(batch):
+        try:
+            importer.record(batch, *await _commit_with_retry_async(storage, batch, retries))
+        finally:
+            slots.release()
+
+    async def flush():
+        for batch in importer.take_batches():
+            await slots.acquire()
+            task = asyncio.create_task(commit(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async for line in lines:
+        if importer.add(line):
+            await flush()
+    await flush()
+    await asyncio.gather(*tasks)
+    return importer.report()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser(description="Bulk import (username, date) rows into menstrual_data.")
+    parser.add_argument("path", help='NDJSON or CSV file, or "-" for stdin.')
+    parser.add_argument("--format", choices=FORMATS, help="Defaults to csv for .csv files, else ndjson.")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=IMPORT_CONCURRENCY)
+    parser.add_argument("--chunk-rows", type=int, default=IMPORT_CHUNK_ROWS)
+    parser.add_argument("--retries", type=int, default=IMPORT_RETRIES)
+    args = parser.parse_args()
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    source = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8", newline="")
+    with source:
+        report = import_lines(source, fmt=fmt, batch_size=args.batch_size, concurrency=args.concurrency,
+                              chunk_rows=args.chunk_rows, retries=args.retries)
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report["failed_batches"] else 0)
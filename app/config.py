@@ -0,0 +1,21 @@
+import json
+import logging
+import os
+
+
+def load_flags_json(env_var: str) -> dict:
+    """Load a JSON object of feature flags from an env variable, or {} if missing/invalid."""
+    raw = os.environ.get(env_var)
+    if not raw:
+        logging.warning(f"{env_var} not found. Using defaults.")
+        return {}
+    try:
+        flags = json.loads(raw)
+    except Exception as e:
+        logging.warning(f"Failed to parse {env_var}: {e}. Using defaults.")
+        return {}
+    if not isinstance(flags, dict):
+        logging.warning(f"{env_var} must be a JSON object. Using defaults.")
+        return {}
+    logging.info(f"Feature flags loaded from {env_var}: {flags}")
+    return flags
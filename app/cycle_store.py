@@ -0,0 +1,204 @@
+import logging
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import date, datetime
+
+import numpy as np
+
+from app.invalidation import InvalidationVersions
+
+# Cycle dates are held as int32 days since 1970-01-01
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_FORECAST_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_FORECAST_TTL_SECONDS = 3600
+# Rough per-entry bookkeeping cost of the OrderedDict slot and its tuple
+_ENTRY_OVERHEAD_BYTES = 200
+
+
+def to_day(value: str) -> int:
+    """Parse an ISO date string ("YYYY-MM-DD", optionally with a time part) to days since the epoch."""
+    return date.fromisoformat(value[:10]).toordinal() - EPOCH_ORDINAL
+
+
+def normalize_date(value) -> str:
+    """
+    Strictly parse a client-supplied date ("YYYY-MM-DD" or a full ISO datetime) and return it as
+    "YYYY-MM-DD"; raises ValueError. Unlike to_day, trailing text is rejected.
+    """
+    if not isinstance(value, str):
+        raise ValueError(f"Not a date: {value!r}")
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        return datetime.fromisoformat(value).date().isoformat()
+
+
+def from_day(day: int) -> date:
+    return date.fromordinal(int(day) + EPOCH_ORDINAL)
+
+
+class CycleHistory:
+    """
+    A user's cycle dates as a sorted, de-duplicated int32 buffer of days since the epoch,
+    plus the user's online model state (app.model.CycleModelState) once it has been loaded.
+    The state is kept packed in an array("d") (see CycleModelState.to_array) and unpacked on
+    access; a cached user with two years of history takes about 670 bytes including the store
+    entry (measured with tracemalloc). state_stored tells whether that state is the one persisted
+    with the dates (False when it was missing or stale and had to be rebuilt).
+    """
+
+    __slots__ = ("days", "update_time", "_state", "state_stored")
+
+    def __init__(self, days=None, update_time=None):
+        self.days = days if days is not None else array("i")
+        self.update_time = update_time
+        self._state = None
+        self.state_stored = False
+
+    @property
+    def model_state(self):
+        """A new CycleModelState unpacked from the history's packed state, or None if unset."""
+        if self._state is None:
+            return None
+        from app.model import CycleModelState
+        return CycleModelState.from_array(self._state)
+
+    @model_state.setter
+    def model_state(self, state):
+        self._state = state.to_array() if state is not None else None
+
+    @classmethod
+    def from_dates(cls, dates, update_time=None):
+        """Parse ISO date strings once; unparseable entries are skipped."""
+        parsed = set()
+        for value in dates:
+            try:
+                parsed.add(to_day(value))
+            except (TypeError, ValueError):
+                logging.warning(f"Skipping invalid cycle date {value!r}")
+        return cls(array("i", sorted(parsed)), update_time)
+
+    @classmethod
+    def from_days(cls, days, update_time=None):
+        return cls(array("i", sorted(set(days))), update_time)
+
+    def __len__(self):
+        return len(self.days)
+
+    def to_numpy(self) -> np.ndarray:
+        """Zero-copy int32 view of the history."""
+        return np.frombuffer(self.days, dtype=np.int32) if len(self.days) else np.empty(0, dtype=np.int32)
+
+    def iso_dates(self):
+        return [from_day(d).isoformat() for d in self.days]
+
+    def nbytes(self) -> int:
+        size = sys.getsizeof(self) + sys.getsizeof(self.days)
+        if self._state is not None:
+            size += sys.getsizeof(self._state)
+        return size
+
+
+class CycleStore:
+    """
+    Process-wide LRU store of parsed CycleHistory objects (or other per-user values with an
+    nbytes() method, such as model.CycleForecast), bounded by approximate memory use.
+    Writes to a user's cycle data must call invalidate(username), which bumps only that user's
+    version, so a write for one user never discards another user's concurrent put.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = InvalidationVersions()
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_bytes: int = None, ttl_seconds: float = None):
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = int(max_bytes)
+            if ttl_seconds is not None:
+                self.ttl_seconds = float(ttl_seconds)
+            self._evict()
+        logging.info(f"Cycle store configured: max_bytes={self.max_bytes}, ttl_seconds={self.ttl_seconds}")
+
+    def token(self, username: str) -> int:
+        """Take before reading a user's data; pass to put() so histories raced by a write are not stored."""
+        with self._lock:
+            return self._versions.version(username)
+
+    def get(self, username: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+            history, size, expires_at = entry
+            if expires_at <= now:
+                del self._entries[username]
+                self.bytes -= size
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return history
+
+    def put(self, username: str, history, token: int = None):
+        size = history.nbytes() + sys.getsizeof(username) + _ENTRY_OVERHEAD_BYTES
+        with self._lock:
+            if token is not None and token != self._versions.version(username):
+                return
+            old = self._entries.pop(username, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[username] = (history, size, time.monotonic() + self.ttl_seconds)
+            self.bytes += size
+            self._evict()
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._versions.bump(username)
+            old = self._entries.pop(username, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._versions.bump_all()
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        while self._entries and self.bytes > self.max_bytes:
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+
+cycle_store = CycleStore()
+# Per-user CycleForecast projections; each is a few KB, so the store is bounded by bytes as well
+forecast_cache = CycleStore(max_bytes=DEFAULT_FORECAST_MAX_BYTES, ttl_seconds=DEFAULT_FORECAST_TTL_SECONDS)
@@ -0,0 +1,207 @@
+"""
+Streaming export of menstrual_data and prediction_feedback. Both are read a page at a time with
+cursor-based queries and written out as NDJSON, or as Parquet when pyarrow is installed, so memory
+stays bounded by one page whatever the dataset size. Every NDJSON line carries a "cursor" token; an
+export restarted with that token resumes right after the line.
+
+Usage: python -m app.export cycle_data|feedback [--format parquet] [--output dump.ndjson]
+                            [--cursor TOKEN] [--page-size 500]
+"""
+import argparse
+import base64
+import json
+import logging
+import sys
+from datetime import date, datetime
+
+from app.cycle_store import CycleHistory, from_day
+from app.storage import cycle_dates, get_storage
+
+DATASETS = ("cycle_data", "feedback")
+FORMATS = ("ndjson", "parquet")
+EXPORT_PAGE_SIZE = 500
+MAX_EXPORT_PAGE_SIZE = 1000
+
+# Feedback entries are free-form; these are the fields written to Parquet
+FEEDBACK_COLUMNS = ("username", "predicted_date", "actual_date", "comment", "timestamp")
+
+
+def encode_cursor(dataset: str, after: str) -> str:
+    payload = json.dumps({"dataset": dataset, "after": after}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(dataset: str, token: str) -> str:
+    """Return the key to resume after; raises ValueError for a malformed token or one from another dataset."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        after = payload["after"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError("Invalid export cursor") from e
+    if payload.get("dataset") != dataset or not isinstance(after, str):
+        raise ValueError(f"Export cursor does not belong to {dataset}")
+    return after
+
+
+def _cycle_record(username, data, update_time) -> dict:
+    history = CycleHistory.from_dates(cycle_dates(data))
+    return {"username": username, "dates": [from_day(d) for d in history.days], "update_time": update_time}
+
+
+def _feedback_record(entry_id, data) -> dict:
+    return {"id": entry_id, **data}
+
+
+def iter_pages(dataset: str, cursor: str = None, page_size: int = EXPORT_PAGE_SIZE):
+    """Yield lists of (key, record) one storage page at a time, starting after the cursor token."""
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown export dataset {dataset!r}; expected one of {DATASETS}")
+    after = decode_cursor(dataset, cursor) if cursor else None
+    page_size = max(1, min(page_size, MAX_EXPORT_PAGE_SIZE))
+    storage = get_storage()
+    while True:
+        if dataset == "cycle_data":
+            items, after = storage.page_cycle_docs(after, page_size)
+            page = [(username, _cycle_record(username, data, update_time)) for username, data, update_time in items]
+        else:
+            items, after = storage.page_feedback(after, page_size)
+            page = [(entry_id, _feedback_record(entry_id, data)) for entry_id, data in items]
+        if page:
+            yield page
+        if after is None:
+            return
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def export_ndjson(dataset: str, cursor: str = None, page_size: int = EXPORT_PAGE_SIZE, on_page=None):
+    """Yield the export as NDJSON bytes, one chunk per page. on_page(page) is called after each page."""
+    for page in iter_pages(dataset, cursor, page_size):
+        lines = []
+        for key, record in page:
+            record["cursor"] = encode_cursor(dataset, key)
+            lines.append(json.dumps(record, default=_json_default))
+        yield ("\n".join(lines) + "\n").encode()
+        if on_page is not None:
+            on_page(page)
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _ChunkSink:
+    """Write-only file object that hands out whatever has been written since the last drain()."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet_schema(pa, dataset: str):
+    if dataset == "cycle_data":
+        return pa.schema([
+            ("username", pa.string()),
+            ("dates", pa.list_(pa.date32())),
+            ("update_time", pa.timestamp("us", tz="UTC")),
+        ])
+    return pa.schema([("id", pa.string())] + [(c, pa.string()) for c in FEEDBACK_COLUMNS]
+                     + [("created_at", pa.timestamp("us", tz="UTC"))])
+
+
+def _parquet_row(dataset: str, record: dict) -> dict:
+    if dataset == "cycle_data":
+        return record
+    row = {c: None if record.get(c) is None else str(record[c]) for c in ("id",) + FEEDBACK_COLUMNS}
+    created_at = record.get("created_at")
+    row["created_at"] = created_at if isinstance(created_at, datetime) else None
+    return row
+
+
+def export_parquet(dataset: str, cursor: str = None, page_size: int = EXPORT_PAGE_SIZE, on_page=None):
+    """Yield the export as a Parquet file in chunks, one row group per page. Requires pyarrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema(pa, dataset)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for page in iter_pages(dataset, cursor, page_size):
+        writer.write_table(pa.Table.from_pylist([_parquet_row(dataset, record) for _, record in page], schema=schema))
+        yield sink.drain()
+        if on_page is not None:
+            on_page(page)
+    writer.close()
+    yield sink.drain()
+
+
+def export(dataset: str, fmt: str = "ndjson", cursor: str = None, page_size: int = EXPORT_PAGE_SIZE, on_page=None):
+    """
+    The export of `dataset` as a generator of bytes in the given format. Raises ValueError up front
+    for an unknown dataset or format and for an invalid cursor.
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown export dataset {dataset!r}; expected one of {DATASETS}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}; expected one of {FORMATS}")
+    if cursor:
+        decode_cursor(dataset, cursor)
+    if fmt == "parquet":
+        return export_parquet(dataset, cursor, page_size, on_page)
+    return export_ndjson(dataset, cursor, page_size, on_page)
+
+
+def _log_progress(dataset: str):
+    exported = 0
+
+    def on_page(page):
+        nonlocal exported
+        exported += len(page)
+        # Logged per page so an interrupted dump can be resumed with --cursor
+        logging.info(f"Exported {exported} {dataset} records; resume with --cursor {encode_cursor(dataset, page[-1][0])}")
+    return on_page
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser(description="Stream menstrual_data or prediction_feedback to NDJSON/Parquet.")
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    parser.add_argument("--output", help="Output file (default: stdout).")
+    parser.add_argument("--cursor", help="Resume after the record that carried this cursor token.")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    args = parser.parse_args()
+    if args.format == "parquet" and not parquet_available():
+        parser.error("Parquet export requires pyarrow (pip install pyarrow).")
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    with out:
+        for chunk in export(args.dataset, args.format, args.cursor, args.page_size, on_page=_log_progress(args.dataset)):
+            out.write(chunk)
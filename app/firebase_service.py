@@ -1,86 +1,401 @@
-import os
-import firebase_admin
-from firebase_admin import credentials, firestore
 import logging
-from datetime import datetime
-
-# Load Firestore credentials from env or fallback to file
-firebase_key_json = os.environ.get("FIREBASE_KEY_JSON")
-if firebase_key_json and os.path.isfile(firebase_key_json):
-    cred = credentials.Certificate(firebase_key_json)
-else:
-    # Try to load from env as JSON string (for Railway)
-    import json
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from app.cycle_store import CycleHistory, cycle_store, forecast_cache, from_day, normalize_date, to_day
+from app.metrics import PREDICT_DURATION
+from app.model import CycleForecast, CycleModelState
+from app.prediction_cache import prediction_cache
+from app.single_flight import cycle_reads
+from app.storage import DATES_FIELD, MODEL_STATE_FIELD, cycle_dates, get_storage
+
+# Reads and writes go through the configured storage backend (app/storage.py); this module
+# keeps the parsing, caching and feedback-correction logic that sits on top of it.
+
+
+def _invalidate_user(username: str):
+    # Drop every in-process copy of the user's cycle data after a write
+    prediction_cache.invalidate(username)
+    forecast_cache.invalidate(username)
+    cycle_store.invalidate(username)
+
+
+def _advance_model(date: str):
+    """
+    fields_fn for append_cycle_date that moves the persisted model state forward by one date in O(1).
+    A missing or out-of-date state, or a date before the last one, is rebuilt from the stored dates.
+    Unparseable dates are skipped when histories are read, so they are appended without touching the
+    state, and the state is compared against the parsed dates of documents that already hold some.
+    """
     try:
-        firebase_key_json_str = os.environ.get("FIREBASE_KEY_JSON")
-        if firebase_key_json_str:
-            cred = credentials.Certificate(json.loads(firebase_key_json_str))
-        else:
-            cred = credentials.Certificate("app/firebase_key.json")
-    except Exception:
-        cred = credentials.Certificate("app/firebase_key.json")
+        day = to_day(date)
+    except (TypeError, ValueError):
+        return None
 
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+    def advance(data):
+        dates = cycle_dates(data)
+        state = CycleModelState.from_dict(data.get(MODEL_STATE_FIELD))
+        # Parsing is only needed for documents holding unparseable (e.g. legacy) entries
+        if (state is None or (state.count != len(dates) and state.count != len(CycleHistory.from_dates(dates)))
+                or not state.append(day)):
+            state = CycleModelState.from_days(CycleHistory.from_dates(dates + [date]).days)
+        return {MODEL_STATE_FIELD: state.to_dict()}
+    return advance
 
 
-def fetch_cycle_data(collection_name: str = "menstrual_data"):
+def _cached_append(username: str, date: str):
+    """
+    (fields, update_time) for appending date with a single conditional write: the next model state
+    is built from the cached history, assuming the document is still at its update time. None when
+    the history is not cached or the date is unparseable.
+    """
+    history = cycle_store.get(username)
+    if history is None or history.update_time is None:
+        return None
+    try:
+        day = to_day(date)
+    except (TypeError, ValueError):
+        return None
+    state = history.model_state
+    if not state.append(day):
+        state = CycleModelState.from_days(sorted(set(history.days) | {day}))
+    return {MODEL_STATE_FIELD: state.to_dict()}, history.update_time
+
+
+def _history_from_doc(data, update_time) -> CycleHistory:
+    if data is None:
+        history = CycleHistory()
+    else:
+        history = CycleHistory.from_dates(cycle_dates(data), update_time)
+    # The persisted state is used when it matches the dates; otherwise it is rebuilt in memory
+    # (and written back by the next training run, see store_model_state)
+    stored = CycleModelState.from_dict((data or {}).get(MODEL_STATE_FIELD))
+    history.state_stored = stored is not None and stored.matches(history)
+    history.model_state = stored if history.state_stored else CycleModelState.from_days(history.days)
+    return history
+
+
+def _cache_histories(result, docs, tokens):
+    for username, (data, update_time) in docs.items():
+        result[username] = _history_from_doc(data, update_time)
+        cycle_store.put(username, result[username], token=tokens[username])
+    return {u: history if history is not None else CycleHistory() for u, history in result.items()}
+
+
+def _load_cycle_history(collection_name: str, token: int) -> CycleHistory:
     logging.info(f"Fetching cycle data for user: {collection_name} (document ID) in 'menstrual_data' collection...")
-    doc = db.collection("menstrual_data").document(collection_name).get()
-    if not doc.exists:
-        logging.info(f"No cycle data found for user {collection_name}.")
-        return []
-    data = doc.to_dict() or {}
-    # Only keep fields that are serial numbers (1, 2, 3, ...)
-    serial_dates = [(int(k), v) for k, v in data.items() if k.isdigit()]
-    serial_dates.sort()
-    dates = [v for _, v in serial_dates]
-    logging.info(f"Fetched {len(dates)} cycle dates for user {collection_name}.")
-    return dates
-
-
-def fetch_feedback(collection_name: str = "prediction_feedback"):
-    logging.info(
-        f"Fetching prediction feedback from Firestore collection: {collection_name}...")
-    docs = db.collection(collection_name).stream()
-    feedback = [doc.to_dict() for doc in docs]
+    history = _history_from_doc(*get_storage().get_cycle_doc(collection_name))
+    cycle_store.put(collection_name, history, token=token)
+    logging.info(f"Fetched {len(history)} cycle dates for user {collection_name}.")
+    return history
+
+
+def fetch_cycle_history(collection_name: str = "menstrual_data") -> CycleHistory:
+    """Fetch a user's parsed cycle history, served from the process-wide cycle store when possible."""
+    history = cycle_store.get(collection_name)
+    if history is not None:
+        return history
+    token = cycle_store.token(collection_name)
+    # Concurrent misses for the same user (and the same version) share one storage read
+    return cycle_reads.do((collection_name, token), _load_cycle_history, collection_name, token)
+
+
+def fetch_cycle_data(collection_name: str = "menstrual_data"):
+    return fetch_cycle_history(collection_name).iso_dates()
+
+
+def fetch_cycle_histories_batch(usernames):
+    """Fetch parsed histories for many users; cycle store misses are read with one bulk read."""
+    result = {username: cycle_store.get(username) for username in usernames}
+    missing = [u for u, history in result.items() if history is None]
+    logging.info(f"Fetching cycle data for {len(missing)} of {len(result)} users in 'menstrual_data' collection...")
+    tokens = {username: cycle_store.token(username) for username in missing}
+    return _cache_histories(result, get_storage().get_cycle_docs(missing) if missing else {}, tokens)
+
+
+def fetch_feedback(collection_name: str = "prediction_feedback", username: str = None, since=None):
+    """
+    Fetch feedback entries, optionally only one user's and only those created after `since`. The
+    collection name is fixed by the storage backend; the parameter is accepted and ignored.
+    """
+    logging.info(f"Fetching prediction feedback (username={username}, since={since})...")
+    feedback = get_storage().query_feedback(username=username, since=since)
     logging.info(f"Fetched {len(feedback)} feedback entries.")
     return feedback
 
 
-def store_feedback(feedback_data, collection_name: str = "prediction_feedback", data_collection: str = "menstrual_data"):
-    logging.info(f"Storing feedback in collection {collection_name}: {feedback_data}")
-    db.collection(collection_name).add(feedback_data)
-    logging.info("Feedback stored in Firestore.")
-    # --- Correction logic ---
+# A reported date within this many days of a stored one corrects it instead of adding a new date
+CORRECTION_WINDOW_DAYS = 7
+
+
+def _feedback_corrections(history: CycleHistory, actual_days):
+    """
+    Return (new_history, replaced_days) after placing each actual day in a user's history, in order:
+    the nearest stored date (the earlier one on a tie) is corrected in place when it is within
+    CORRECTION_WINDOW_DAYS, otherwise the day is inserted. Lookups bisect the sorted days, so each
+    entry costs O(log n) comparisons. replaced_days[i] is the day actual_days[i] replaced, or None.
+    """
+    days = array("i", history.days)
+    replaced_days = []
+    for actual_day in actual_days:
+        i = bisect_left(days, actual_day)
+        # Nearest neighbour is days[i - 1] or days[i]
+        if i > 0 and (i == len(days) or actual_day - days[i - 1] <= days[i] - actual_day):
+            i -= 1
+        if i < len(days) and abs(days[i] - actual_day) <= CORRECTION_WINDOW_DAYS:
+            # Anything between the nearest date and actual_day would be nearer, so order is kept
+            replaced_days.append(days[i])
+            days[i] = actual_day
+        else:
+            replaced_days.append(None)
+            insort(days, actual_day)
+    return CycleHistory(days), replaced_days
+
+
+def _correction_fields(data, actual_days):
+    # Read-modify-write step the backend runs atomically against the user's cycle document
+    new_history, replaced_days = _feedback_corrections(_history_from_doc(data, None), actual_days)
+    fields = {
+        DATES_FIELD: new_history.iso_dates(),
+        MODEL_STATE_FIELD: CycleModelState.from_days(new_history.days).to_dict(),
+    }
+    return fields, replaced_days
+
+
+def _correction(actual_day: int):
+    def apply(data):
+        fields, replaced_days = _correction_fields(data, [actual_day])
+        return fields, replaced_days[0]
+    return apply
+
+
+def _parse_actual_day(actual_date: str):
+    try:
+        return to_day(normalize_date(actual_date))
+    except (TypeError, ValueError):
+        logging.warning(f"Ignoring feedback with invalid actual_date {actual_date!r}")
+        return None
+
+
+def _correction_target(feedback_data):
+    """(username, actual_date, actual_day) for feedback that corrects the user's dates, else None."""
     actual_date = feedback_data.get("actual_date")
     username = feedback_data.get("username")
     if not actual_date or not username:
-        return
-    # Fetch user's menstrual_data document
-    user_doc_ref = db.collection("menstrual_data").document(username)
-    user_doc = user_doc_ref.get()
-    if user_doc.exists:
-        data = user_doc.to_dict() or {}
-        # Check if date already exists (within 7 days)
-        found = False
-        for k, v in data.items():
-            try:
-                existing_dt = datetime.strptime(v, "%Y-%m-%d")
-                actual_dt = datetime.strptime(actual_date, "%Y-%m-%d")
-                if abs((existing_dt - actual_dt).days) <= 7:
-                    user_doc_ref.update({k: actual_date})
-                    logging.info(f"Updated {username}'s cycle date at key {k} to {actual_date}")
-                    found = True
-                    break
-            except Exception:
-                continue
-        if not found:
-            # Add as new serial number
-            next_key = str(len([k for k in data.keys() if k.isdigit()]) + 1)
-            user_doc_ref.update({next_key: actual_date})
-            logging.info(f"Added new cycle date for {username} at key {next_key}: {actual_date}")
+        return None
+    actual_day = _parse_actual_day(actual_date)
+    if actual_day is None:
+        return None
+    return username, actual_date, actual_day
+
+
+def _corrected(username: str, replaced, actual_date: str):
+    if replaced is not None:
+        logging.info(f"Updated {username}'s cycle date {from_day(replaced)} to {actual_date}")
     else:
-        # Create new document for user
-        user_doc_ref.set({"1": actual_date})
-        logging.info(f"Created new menstrual_data document for {username} with date {actual_date}")
+        logging.info(f"Added new cycle date for {username}: {actual_date}")
+    _invalidate_user(username)
+
+
+def store_feedback(feedback_data, collection_name: str = "prediction_feedback", data_collection: str = "menstrual_data"):
+    """
+    Store a feedback entry and apply its correction to the user's dates. The collection names are
+    fixed by the storage backend; the parameters are accepted for existing callers and ignored.
+    """
+    logging.info(f"Storing feedback: {feedback_data}")
+    storage = get_storage()
+    storage.add_feedback(feedback_data)
+    logging.info("Feedback stored.")
+    target = _correction_target(feedback_data)
+    if target is not None:
+        username, actual_date, actual_day = target
+        _corrected(username, storage.update_cycle_doc(username, _correction(actual_day)), actual_date)
+
+
+def _group_corrections(entries):
+    """{username: [actual days in submission order]} for entries that carry a valid actual_date."""
+    corrections = defaultdict(list)
+    for entry in entries:
+        username, actual_date = entry.get("username"), entry.get("actual_date")
+        if not username or not actual_date:
+            continue
+        actual_day = _parse_actual_day(actual_date)
+        if actual_day is not None:
+            corrections[username].append(actual_day)
+    return corrections
+
+
+def _batch_corrections(entries):
+    """(usernames, fn) for update_cycle_docs applying each user's corrections from a feedback batch."""
+    corrections = _group_corrections(entries)
+    return list(corrections), lambda username, data: _correction_fields(data, corrections[username])
+
+
+def _batch_stored(entries, replaced_by_user) -> dict:
+    for username in replaced_by_user:
+        _invalidate_user(username)
+    replaced = [r for replaced_days in replaced_by_user.values() for r in replaced_days]
+    corrected = sum(r is not None for r in replaced)
+    summary = {
+        "stored": len(entries),
+        "users": len(replaced_by_user),
+        "corrected": corrected,
+        "added": len(replaced) - corrected,
+    }
+    logging.info(f"Feedback batch stored: {summary}")
+    return summary
+
+
+def store_feedback_batch(entries) -> dict:
+    """
+    Store many feedback entries and apply their corrections in one pass: feedback documents are
+    written in batches, and each affected user's dates are corrected with a single batched write.
+    """
+    logging.info(f"Storing {len(entries)} feedback entries...")
+    storage = get_storage()
+    storage.add_feedback_batch(entries)
+    return _batch_stored(entries, storage.update_cycle_docs(*_batch_corrections(entries)))
+
+
+# --- Scheduled retraining state ---
+
+def list_usernames(page_size: int = 300):
+    """Yield every registered username, paging through the users collection."""
+    return get_storage().list_usernames(page_size=page_size)
+
+
+def fetch_cycle_snapshots_batch(usernames):
+    """
+    Bulk-read menstrual_data for many users. Returns {username: CycleHistory} for existing docs;
+    the histories are not put in the cycle store, so a full scan does not evict hot users.
+    """
+    docs = get_storage().get_cycle_docs(usernames)
+    return {u: _history_from_doc(data, update_time) for u, (data, update_time) in docs.items()}
+
+
+def store_model_state(username: str, history: CycleHistory):
+    """
+    Persist the history's model state, if the document is unchanged since the history was read.
+    Returns the document's new update time, or None when it changed (nothing is written then).
+    """
+    update_time = get_storage().write_cycle_fields(
+        username, {MODEL_STATE_FIELD: history.model_state.to_dict()}, history.update_time)
+    if update_time is not None:
+        _invalidate_user(username)
+        logging.info(f"Stored rebuilt model state for {username}.")
+    return update_time
+
+
+def fetch_training_watermarks(usernames):
+    """Returns {username: data_update_time} for users that have been trained before."""
+    return get_storage().get_training_watermarks(usernames)
+
+
+def store_training_watermark(username: str, data_update_time):
+    get_storage().set_training_watermark(username, data_update_time)
+
+
+def get_training_run_state() -> dict:
+    return get_storage().get_training_run_state()
+
+
+def set_training_run_state(state: dict):
+    get_storage().set_training_run_state(state)
+
+
+# --- Async data path used by the FastAPI endpoints ---
+# The sync functions above remain for the scheduler and background training.
+
+async def _load_cycle_history_async(collection_name: str, token: int) -> CycleHistory:
+    logging.info(f"Fetching cycle data for user: {collection_name} (document ID) in 'menstrual_data' collection...")
+    history = _history_from_doc(*await get_storage().aget_cycle_doc(collection_name))
+    cycle_store.put(collection_name, history, token=token)
+    logging.info(f"Fetched {len(history)} cycle dates for user {collection_name}.")
+    return history
+
+
+async def fetch_cycle_history_async(collection_name: str = "menstrual_data") -> CycleHistory:
+    history = cycle_store.get(collection_name)
+    if history is not None:
+        return history
+    token = cycle_store.token(collection_name)
+    # Shares flights with the sync path, e.g. /predict on the loop and login-triggered training in a thread
+    return await cycle_reads.ado((collection_name, token), _load_cycle_history_async, collection_name, token)
+
+
+async def fetch_forecast_async(collection_name: str = "menstrual_data") -> CycleForecast:
+    """The user's multi-cycle forecast, computed once per version of their cycle history."""
+    token = forecast_cache.token(collection_name)
+    forecast = forecast_cache.get(collection_name)
+    # A cached forecast is checked against the document's update time alone; only a stale or
+    # missing one loads the history
+    if forecast is not None and forecast.update_time == await fetch_cycle_update_time_async(collection_name):
+        return forecast
+    history = await fetch_cycle_history_async(collection_name)
+    with PREDICT_DURATION.labels("forecast").time():
+        forecast = CycleForecast(history.model_state, update_time=history.update_time)
+    forecast_cache.put(collection_name, forecast, token=token)
+    return forecast
+
+
+async def fetch_cycle_update_time_async(collection_name: str = "menstrual_data"):
+    """The cycle document's update time, from the cycle store or a metadata-only read (for ETags)."""
+    history = cycle_store.get(collection_name)
+    if history is not None:
+        return history.update_time
+    return await get_storage().aget_cycle_update_time(collection_name)
+
+
+async def fetch_cycle_histories_batch_async(usernames):
+    result = {username: cycle_store.get(username) for username in usernames}
+    missing = [u for u, history in result.items() if history is None]
+    logging.info(f"Fetching cycle data for {len(missing)} of {len(result)} users in 'menstrual_data' collection...")
+    tokens = {username: cycle_store.token(username) for username in missing}
+    return _cache_histories(result, await get_storage().aget_cycle_docs(missing) if missing else {}, tokens)
+
+
+async def fetch_feedback_async(collection_name: str = "prediction_feedback", username: str = None, since=None):
+    # Collection parameter is ignored, as in fetch_feedback
+    logging.info(f"Fetching prediction feedback (username={username}, since={since})...")
+    feedback = await get_storage().aquery_feedback(username=username, since=since)
+    logging.info(f"Fetched {len(feedback)} feedback entries.")
+    return feedback
+
+
+async def store_feedback_async(feedback_data, collection_name: str = "prediction_feedback",
+                               data_collection: str = "menstrual_data"):
+    # Collection parameters are ignored, as in store_feedback
+    logging.info(f"Storing feedback: {feedback_data}")
+    storage = get_storage()
+    await storage.aadd_feedback(feedback_data)
+    logging.info("Feedback stored.")
+    target = _correction_target(feedback_data)
+    if target is not None:
+        username, actual_date, actual_day = target
+        _corrected(username, await storage.aupdate_cycle_doc(username, _correction(actual_day)), actual_date)
+
+
+async def store_feedback_batch_async(entries) -> dict:
+    logging.info(f"Storing {len(entries)} feedback entries...")
+    storage = get_storage()
+    await storage.aadd_feedback_batch(entries)
+    return _batch_stored(entries, await storage.aupdate_cycle_docs(*_batch_corrections(entries)))
+
+
+async def add_cycle_date_async(username: str, date: str):
+    """
+    Append a date to a user's menstrual_data document (created if missing): one conditional write
+    when the user's history is cached, else (or if the document changed since) a transaction.
+    """
+    storage = get_storage()
+    cached = _cached_append(username, date)
+    if cached is None or await storage.awrite_cycle_fields(username, *cached, date=date) is None:
+        await storage.aappend_cycle_date(username, date, _advance_model(date))
+    _invalidate_user(username)
+    logging.info(f"Added cycle date for {username}: {date}")
+
+
+async def log_prediction_feedback_async(doc_name: str, log_data: dict):
+    """Write a /feedback log document under an explicit document name."""
+    await get_storage().aadd_feedback(log_data, doc_id=doc_name)
+    logging.info(f"Feedback log {doc_name} stored.")
@@ -0,0 +1,449 @@
+import json
+import logging
+import os
+import threading
+
+from app.storage import (
+    CYCLE_DATA,
+    DATES_FIELD,
+    FEEDBACK,
+    MODEL_STATE_FIELD,
+    TRAINING_RUNS,
+    TRAINING_WATERMARKS,
+    USERS,
+    StorageBackend,
+    legacy_keys,
+)
+
+# Maximum number of document references sent in a single get_all call
+GET_ALL_CHUNK_SIZE = 300
+# Firestore allows at most 500 writes per batch
+MAX_BATCH_WRITES = 500
+
+# The Firebase app and Firestore clients are created lazily, once, on first use:
+# importing google-cloud-firestore/grpc and building clients dominates cold-start time.
+_init_lock = threading.Lock()
+_db = None
+_async_db = None
+
+
+def _firestore():
+    from firebase_admin import firestore
+    return firestore
+
+
+def _load_credentials():
+    from firebase_admin import credentials
+    # Load Firestore credentials from env or fallback to file
+    firebase_key_json = os.environ.get("FIREBASE_KEY_JSON")
+    if firebase_key_json and os.path.isfile(firebase_key_json):
+        return credentials.Certificate(firebase_key_json)
+    # Try to load from env as JSON string (for Railway)
+    try:
+        if firebase_key_json:
+            return credentials.Certificate(json.loads(firebase_key_json))
+        return credentials.Certificate("app/firebase_key.json")
+    except Exception:
+        return credentials.Certificate("app/firebase_key.json")
+
+
+def _ensure_app():
+    import firebase_admin
+    try:
+        return firebase_admin.get_app()
+    except ValueError:
+        logging.info("Initializing Firebase app...")
+        return firebase_admin.initialize_app(_load_credentials())
+
+
+def get_db():
+    """Sync Firestore client (scheduler, background training, scripts)."""
+    global _db
+    if _db is None:
+        with _init_lock:
+            if _db is None:
+                _ensure_app()
+                _db = _firestore().client()
+    return _db
+
+
+def get_async_db():
+    """Firestore AsyncClient for the FastAPI endpoints, created on first use inside the serving event loop."""
+    global _async_db
+    if _async_db is None:
+        with _init_lock:
+            if _async_db is None:
+                from firebase_admin import firestore_async
+                _ensure_app()
+                _async_db = firestore_async.client()
+    return _async_db
+
+
+def _doc_data(doc):
+    return (doc.to_dict() or {}) if doc.exists else None
+
+
+def _rewrite_doc(transaction, doc_ref, snapshot, fn):
+    # Rewrites the document in the array layout, dropping any legacy serial-number fields
+    data = _doc_data(snapshot) or {}
+    fields, result = fn(data)
+    update = dict(fields)
+    update.update({k: _firestore().DELETE_FIELD for k in legacy_keys(data)})
+    if snapshot.exists:
+        transaction.update(doc_ref, update)
+    else:
+        transaction.set(doc_ref, update)
+    return result
+
+
+def _update_doc_txn(transaction, doc_ref, fn):
+    return _rewrite_doc(transaction, doc_ref, doc_ref.get(transaction=transaction), fn)
+
+
+async def _update_doc_txn_async(transaction, doc_ref, fn):
+    return _rewrite_doc(transaction, doc_ref, await doc_ref.get(transaction=transaction), fn)
+
+
+def _batch_rewrite(db, batch, snapshot, fn):
+    # Same rewrite as _rewrite_doc, conditioned on the update time that was read so a concurrent
+    # write fails the batch instead of being overwritten
+    data = _doc_data(snapshot) or {}
+    fields, result = fn(snapshot.id, data)
+    update = dict(fields)
+    update.update({k: _firestore().DELETE_FIELD for k in legacy_keys(data)})
+    if snapshot.exists:
+        batch.update(snapshot.reference, update, option=db.write_option(last_update_time=snapshot.update_time))
+    else:
+        batch.create(snapshot.reference, update)
+    return result
+
+
+def _username_chunks(usernames):
+    for start in range(0, len(usernames), GET_ALL_CHUNK_SIZE):
+        yield usernames[start:start + GET_ALL_CHUNK_SIZE]
+
+
+def _rewrite_batch(db, snapshots, fn):
+    """Stage the rewrite of every snapshot on one new batch; returns (batch, {username: result})."""
+    batch = db.batch()
+    return batch, {snapshot.id: _batch_rewrite(db, batch, snapshot, fn) for snapshot in snapshots}
+
+
+def _per_doc_retries(chunk, fn):
+    # Fallback for a batch that lost a race: (username, single-document fn) for update_cycle_doc
+    logging.warning(f"Batch of {len(chunk)} cycle documents changed while updating; retrying individually.")
+    return [(u, lambda data, u=u: fn(u, data)) for u in chunk]
+
+
+def _feedback_batches(collection, entries):
+    for start in range(0, len(entries), MAX_BATCH_WRITES):
+        yield [(collection.document(), {**data, "created_at": _firestore().SERVER_TIMESTAMP})
+               for data in entries[start:start + MAX_BATCH_WRITES]]
+
+
+def _import_writes(collection, histories):
+    items = list(histories.items())
+    for start in range(0, len(items), MAX_BATCH_WRITES):
+        # ArrayUnion merges server-side, so no reads are needed; the stale model state is dropped
+        yield [(collection.document(username), {
+            DATES_FIELD: _firestore().ArrayUnion(list(dates)),
+            MODEL_STATE_FIELD: _firestore().DELETE_FIELD,
+        }) for username, dates in items[start:start + MAX_BATCH_WRITES]]
+
+
+def _append_update(date: str) -> dict:
+    # ArrayUnion is applied server-side, so a plain append is a single write with no prior read
+    return {DATES_FIELD: _firestore().ArrayUnion([date])}
+
+
+def _fields_update(fields, date):
+    update = dict(fields)
+    if date is not None:
+        update.update(_append_update(date))
+    return update
+
+
+def _append_write(transaction, doc_ref, snapshot, date, fields_fn):
+    update = _append_update(date)
+    update.update(fields_fn(_doc_data(snapshot) or {}))
+    transaction.set(doc_ref, update, merge=True)
+
+
+def _append_txn(transaction, doc_ref, date, fields_fn):
+    _append_write(transaction, doc_ref, doc_ref.get(transaction=transaction), date, fields_fn)
+
+
+async def _append_txn_async(transaction, doc_ref, date, fields_fn):
+    _append_write(transaction, doc_ref, await doc_ref.get(transaction=transaction), date, fields_fn)
+
+
+def _feedback_query(collection, username=None, since=None):
+    # Feedback documents carry the username plus a server-set created_at timestamp;
+    # filtering on both needs a composite index on (username, created_at).
+    query = collection
+    if username is not None:
+        query = query.where(filter=_firestore().FieldFilter("username", "==", username))
+    if since is not None:
+        query = query.where(filter=_firestore().FieldFilter("created_at", ">", since))
+    return query
+
+
+def _page(collection, cursor, limit):
+    # Document-ID order with start_after the cursor document, so each page is one indexed query
+    query = collection.order_by("__name__").limit(limit)
+    if cursor:
+        query = query.start_after({"__name__": collection.document(cursor)})
+    docs = list(query.stream())
+    return docs, (docs[-1].id if len(docs) == limit else None)
+
+
+class FirestoreStorage(StorageBackend):
+    name = "firestore"
+
+    # --- Users ---
+    def get_user(self, username):
+        return _doc_data(get_db().collection(USERS).document(username).get())
+
+    def create_user(self, username, data):
+        from google.api_core.exceptions import AlreadyExists
+        # Users are keyed by username; create() fails if the document already exists,
+        # so the duplicate check and the write are a single round trip.
+        try:
+            get_db().collection(USERS).document(username).create(data)
+        except AlreadyExists:
+            return False
+        return True
+
+    def update_user(self, username, fields):
+        get_db().collection(USERS).document(username).update(fields)
+
+    def list_usernames(self, page_size=GET_ALL_CHUNK_SIZE):
+        for ref in get_db().collection(USERS).list_documents(page_size=page_size):
+            yield ref.id
+
+    # --- Cycle data ---
+    def get_cycle_doc(self, username):
+        doc = get_db().collection(CYCLE_DATA).document(username).get()
+        return _doc_data(doc), doc.update_time if doc.exists else None
+
+    def get_cycle_update_time(self, username):
+        # An empty field mask returns the document's metadata only
+        doc = get_db().collection(CYCLE_DATA).document(username).get(field_paths=[])
+        return doc.update_time if doc.exists else None
+
+    def get_cycle_docs(self, usernames):
+        db = get_db()
+        collection = db.collection(CYCLE_DATA)
+        result = {}
+        for start in range(0, len(usernames), GET_ALL_CHUNK_SIZE):
+            refs = [collection.document(u) for u in usernames[start:start + GET_ALL_CHUNK_SIZE]]
+            for doc in db.get_all(refs):
+                if doc.exists:
+                    result[doc.id] = (doc.to_dict() or {}, doc.update_time)
+        return result
+
+    def init_cycle_doc(self, username):
+        get_db().collection(CYCLE_DATA).document(username).set({})
+
+    def append_cycle_date(self, username, date, fields_fn=None):
+        db = get_db()
+        doc_ref = db.collection(CYCLE_DATA).document(username)
+        if fields_fn is None:
+            doc_ref.set(_append_update(date), merge=True)
+            return
+        _firestore().transactional(_append_txn)(db.transaction(), doc_ref, date, fields_fn)
+
+    def write_cycle_fields(self, username, fields, update_time, date=None):
+        from google.api_core.exceptions import FailedPrecondition, NotFound
+        db = get_db()
+        # update() takes the last_update_time precondition (set() does not); the document must exist
+        try:
+            result = db.collection(CYCLE_DATA).document(username).update(
+                _fields_update(fields, date), option=db.write_option(last_update_time=update_time))
+        except (FailedPrecondition, NotFound):
+            return None
+        return result.update_time
+
+    def append_cycle_dates_batch(self, histories):
+        db = get_db()
+        for writes in _import_writes(db.collection(CYCLE_DATA), histories):
+            batch = db.batch()
+            for doc_ref, update in writes:
+                batch.set(doc_ref, update, merge=True)
+            batch.commit()
+
+    def update_cycle_doc(self, username, fn):
+        db = get_db()
+        transactional = _firestore().transactional(_update_doc_txn)
+        return transactional(db.transaction(), db.collection(CYCLE_DATA).document(username), fn)
+
+    def update_cycle_docs(self, usernames, fn):
+        from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+        db = get_db()
+        collection = db.collection(CYCLE_DATA)
+        results = {}
+        for chunk in _username_chunks(usernames):
+            batch, chunk_results = _rewrite_batch(db, db.get_all([collection.document(u) for u in chunk]), fn)
+            try:
+                batch.commit()
+            except (AlreadyExists, FailedPrecondition):
+                chunk_results = {u: self.update_cycle_doc(u, doc_fn) for u, doc_fn in _per_doc_retries(chunk, fn)}
+            results.update(chunk_results)
+        return results
+
+    def page_cycle_docs(self, cursor, limit):
+        docs, next_cursor = _page(get_db().collection(CYCLE_DATA), cursor, limit)
+        return [(doc.id, doc.to_dict() or {}, doc.update_time) for doc in docs], next_cursor
+
+    # --- Feedback ---
+    def add_feedback(self, data, doc_id=None):
+        collection = get_db().collection(FEEDBACK)
+        data = {**data, "created_at": _firestore().SERVER_TIMESTAMP}
+        if doc_id:
+            collection.document(doc_id).set(data)
+        else:
+            collection.add(data)
+
+    def add_feedback_batch(self, entries):
+        db = get_db()
+        for writes in _feedback_batches(db.collection(FEEDBACK), entries):
+            batch = db.batch()
+            for doc_ref, data in writes:
+                batch.set(doc_ref, data)
+            batch.commit()
+
+    def query_feedback(self, username=None, since=None):
+        return [doc.to_dict() for doc in _feedback_query(get_db().collection(FEEDBACK), username, since).stream()]
+
+    def page_feedback(self, cursor, limit):
+        docs, next_cursor = _page(get_db().collection(FEEDBACK), cursor, limit)
+        return [(doc.id, doc.to_dict() or {}) for doc in docs], next_cursor
+
+    # --- Scheduled retraining state ---
+    # training_watermarks/{username} records the menstrual_data update time the user was last trained on;
+    # training_runs/scheduled records whether the last scheduled run finished.
+    def get_training_watermarks(self, usernames):
+        db = get_db()
+        collection = db.collection(TRAINING_WATERMARKS)
+        result = {}
+        for start in range(0, len(usernames), GET_ALL_CHUNK_SIZE):
+            refs = [collection.document(u) for u in usernames[start:start + GET_ALL_CHUNK_SIZE]]
+            for doc in db.get_all(refs):
+                if doc.exists:
+                    result[doc.id] = (doc.to_dict() or {}).get("data_update_time")
+        return result
+
+    def set_training_watermark(self, username, data_update_time):
+        get_db().collection(TRAINING_WATERMARKS).document(username).set({
+            "data_update_time": data_update_time,
+            "trained_at": _firestore().SERVER_TIMESTAMP,
+        })
+
+    def get_training_run_state(self):
+        return _doc_data(get_db().collection(TRAINING_RUNS).document("scheduled").get()) or {}
+
+    def set_training_run_state(self, state):
+        get_db().collection(TRAINING_RUNS).document("scheduled").set(state, merge=True)
+
+    # --- Async variants (Firestore AsyncClient) used by the FastAPI endpoints ---
+    async def aget_user(self, username):
+        return _doc_data(await get_async_db().collection(USERS).document(username).get())
+
+    async def acreate_user(self, username, data):
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            await get_async_db().collection(USERS).document(username).create(data)
+        except AlreadyExists:
+            return False
+        return True
+
+    async def aupdate_user(self, username, fields):
+        await get_async_db().collection(USERS).document(username).update(fields)
+
+    async def aget_cycle_doc(self, username):
+        doc = await get_async_db().collection(CYCLE_DATA).document(username).get()
+        return _doc_data(doc), doc.update_time if doc.exists else None
+
+    async def aget_cycle_update_time(self, username):
+        doc = await get_async_db().collection(CYCLE_DATA).document(username).get(field_paths=[])
+        return doc.update_time if doc.exists else None
+
+    async def aget_cycle_docs(self, usernames):
+        async_db = get_async_db()
+        collection = async_db.collection(CYCLE_DATA)
+        result = {}
+        for start in range(0, len(usernames), GET_ALL_CHUNK_SIZE):
+            refs = [collection.document(u) for u in usernames[start:start + GET_ALL_CHUNK_SIZE]]
+            async for doc in async_db.get_all(refs):
+                if doc.exists:
+                    result[doc.id] = (doc.to_dict() or {}, doc.update_time)
+        return result
+
+    async def ainit_cycle_doc(self, username):
+        await get_async_db().collection(CYCLE_DATA).document(username).set({})
+
+    async def aappend_cycle_date(self, username, date, fields_fn=None):
+        async_db = get_async_db()
+        doc_ref = async_db.collection(CYCLE_DATA).document(username)
+        if fields_fn is None:
+            await doc_ref.set(_append_update(date), merge=True)
+            return
+        await _firestore().async_transactional(_append_txn_async)(async_db.transaction(), doc_ref, date, fields_fn)
+
+    async def awrite_cycle_fields(self, username, fields, update_time, date=None):
+        from google.api_core.exceptions import FailedPrecondition, NotFound
+        async_db = get_async_db()
+        try:
+            result = await async_db.collection(CYCLE_DATA).document(username).update(
+                _fields_update(fields, date), option=async_db.write_option(last_update_time=update_time))
+        except (FailedPrecondition, NotFound):
+            return None
+        return result.update_time
+
+    async def aappend_cycle_dates_batch(self, histories):
+        async_db = get_async_db()
+        for writes in _import_writes(async_db.collection(CYCLE_DATA), histories):
+            batch = async_db.batch()
+            for doc_ref, update in writes:
+                batch.set(doc_ref, update, merge=True)
+            await batch.commit()
+
+    async def aupdate_cycle_doc(self, username, fn):
+        async_db = get_async_db()
+        transactional = _firestore().async_transactional(_update_doc_txn_async)
+        return await transactional(async_db.transaction(), async_db.collection(CYCLE_DATA).document(username), fn)
+
+    async def aupdate_cycle_docs(self, usernames, fn):
+        from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+        async_db = get_async_db()
+        collection = async_db.collection(CYCLE_DATA)
+        results = {}
+        for chunk in _username_chunks(usernames):
+            snapshots = [snapshot async for snapshot in async_db.get_all([collection.document(u) for u in chunk])]
+            batch, chunk_results = _rewrite_batch(async_db, snapshots, fn)
+            try:
+                await batch.commit()
+            except (AlreadyExists, FailedPrecondition):
+                chunk_results = {u: await self.aupdate_cycle_doc(u, doc_fn) for u, doc_fn in _per_doc_retries(chunk, fn)}
+            results.update(chunk_results)
+        return results
+
+    async def aadd_feedback(self, data, doc_id=None):
+        collection = get_async_db().collection(FEEDBACK)
+        data = {**data, "created_at": _firestore().SERVER_TIMESTAMP}
+        if doc_id:
+            await collection.document(doc_id).set(data)
+        else:
+            await collection.add(data)
+
+    async def aadd_feedback_batch(self, entries):
+        async_db = get_async_db()
+        for writes in _feedback_batches(async_db.collection(FEEDBACK), entries):
+            batch = async_db.batch()
+            for doc_ref, data in writes:
+                batch.set(doc_ref, data)
+            await batch.commit()
+
+    async def aquery_feedback(self, username=None, since=None):
+        query = _feedback_query(get_async_db().collection(FEEDBACK), username, since)
+        return [doc.to_dict() async for doc in query.stream()]
@@ -0,0 +1,31 @@
+import hashlib
+
+# Version of the /predict payload; bump when its format or the prediction logic changes so
+# clients holding an old ETag get the new body even though the underlying data did not change
+PREDICT_ETAG_VERSION = "1"
+
+
+def etag_for(kind: str, username: str, update_time) -> str:
+    """Strong ETag for a per-user response derived from the cycle document's update time."""
+    stamp = update_time.isoformat() if hasattr(update_time, "isoformat") else str(update_time)
+    digest = hashlib.sha1(f"{kind}\0{username}\0{stamp}".encode()).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """True when an If-None-Match header matches the ETag (weak comparison, as for GET)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates)
+
+
+def cache_headers(etag: str, max_age_seconds: int = 0) -> dict:
+    """
+    Headers for cacheable per-user responses. Responses are private to the authenticated user;
+    with max_age 0 clients keep the body but revalidate it with If-None-Match on every poll.
+    """
+    directive = f"private, max-age={max_age_seconds}" if max_age_seconds > 0 else "private, no-cache"
+    return {"ETag": etag, "Cache-Control": directive, "Vary": "Authorization"}
@@ -0,0 +1,35 @@
+# Keys whose versions are remembered; past this all versions are folded into one floor
+MAX_TRACKED_VERSIONS = 100_000
+
+
+class InvalidationVersions:
+    """
+    Per-key invalidation versions for caches filled from storage reads. Take version(key) before
+    the read and compare it when storing the result: only bump(key) (a write to that key) or
+    bump_all() changes it, so writes for other keys never discard the result.
+
+    At most max_tracked keys are remembered. Past that every version is folded into one floor,
+    which changes all of them and so only drops results of reads already in flight.
+    Not locked: callers hold the lock of the cache they guard.
+    """
+
+    def __init__(self, max_tracked: int = MAX_TRACKED_VERSIONS):
+        self.max_tracked = max_tracked
+        self._counter = 0
+        self._versions = {}
+        self._floor = 0
+
+    def version(self, key) -> int:
+        return max(self._versions.get(key, 0), self._floor)
+
+    def bump(self, key):
+        self._counter += 1
+        if len(self._versions) >= self.max_tracked:
+            self._floor = self._counter
+            self._versions.clear()
+        self._versions[key] = self._counter
+
+    def bump_all(self):
+        self._counter += 1
+        self._floor = self._counter
+        self._versions.clear()
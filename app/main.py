@@ -1,14 +1,37 @@
 from fastapi import Body
 from starlette.middleware.cors import CORSMiddleware as StarletteCORSMiddleware
-import threading
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from app.firebase_service import fetch_cycle_data, store_feedback
-from app.user_service import create_user, validate_login, get_user_collection
+from app.auth import ADMIN_SCOPE, require_scope, require_user, sessions
+from app.config import load_flags_json
+from app.firebase_service import (
+    add_cycle_date_async,
+    fetch_cycle_histories_batch_async,
+    fetch_cycle_history_async,
+    fetch_forecast_async,
+    fetch_cycle_update_time_async,
+    log_prediction_feedback_async,
+    store_feedback_batch_async,
+)
+from app.cycle_store import cycle_store, forecast_cache, normalize_date
+from app.http_cache import PREDICT_ETAG_VERSION, cache_headers, etag_for, etag_matches
+from app.metrics import PREDICT_DURATION, MetricsMiddleware, observe_training, render_metrics
+from app.prediction_cache import prediction_cache
+from app.single_flight import cycle_reads, user_reads
+from app.user_service import (
+    create_user_async,
+    get_security_question_async,
+    get_user_collection,
+    validate_login_async,
+    verify_security_answer_and_reset_async,
+)
 from app.scheduler import start_scheduler
+from app.training_queue import TrainingQueue
 from app.training_utils import train_with_feedback
 from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from typing import List
 from zoneinfo import ZoneInfo
 import logging
 import os
@@ -19,27 +42,55 @@ try:
 except ImportError:
     logging.warning(
         "python-dotenv not installed; .env file will not be loaded automatically.")
-import os
-import json
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 # Load feature flag from JSON env variable or fallback to True
-scheduler_enabled = True  # Default to True
-scheduler_flag_json = os.environ.get("SCHEDULER_FLAGS_JSON")
-if scheduler_flag_json:
-    try:
-        flags = json.loads(scheduler_flag_json)
-        scheduler_enabled = flags.get("enable_scheduler", True)
-        logging.info(
-            f"Scheduler feature flag loaded from env: enable_scheduler={scheduler_enabled}")
-    except Exception as e:
-        logging.warning(
-            f"Failed to parse SCHEDULER_FLAGS_JSON: {e}. Scheduler will run by default.")
-else:
-    logging.warning(
-        "SCHEDULER_FLAGS_JSON not found. Scheduler will run by default.")
+scheduler_flags = load_flags_json("SCHEDULER_FLAGS_JSON")
+scheduler_enabled = scheduler_flags.get("enable_scheduler", True)
+logging.info(f"Scheduler feature flag: enable_scheduler={scheduler_enabled}")
+
+# Prediction cache size/TTL, e.g. { "max_size": 10000, "ttl_seconds": 3600 }
+prediction_cache_flags = load_flags_json("PREDICTION_CACHE_FLAGS_JSON")
+prediction_cache.configure(
+    max_size=prediction_cache_flags.get("max_size"),
+    ttl_seconds=prediction_cache_flags.get("ttl_seconds"),
+)
+
+# Per-user forecast projections, e.g. { "max_bytes": 67108864, "ttl_seconds": 3600 }
+forecast_cache_flags = load_flags_json("FORECAST_CACHE_FLAGS_JSON")
+forecast_cache.configure(
+    max_bytes=forecast_cache_flags.get("max_bytes"),
+    ttl_seconds=forecast_cache_flags.get("ttl_seconds"),
+)
+
+# Parsed cycle history store, e.g. { "max_bytes": 268435456, "ttl_seconds": 300 }
+cycle_store_flags = load_flags_json("CYCLE_STORE_FLAGS_JSON")
+cycle_store.configure(
+    max_bytes=cycle_store_flags.get("max_bytes"),
+    ttl_seconds=cycle_store_flags.get("ttl_seconds"),
+)
+
+# Session tokens, e.g. { "token_ttl_seconds": 86400 }; the signing key comes from SESSION_SECRET
+auth_flags = load_flags_json("AUTH_FLAGS_JSON")
+sessions.configure(secret=os.environ.get("SESSION_SECRET"), ttl_seconds=auth_flags.get("token_ttl_seconds"))
+
+# Conditional GET for /predict and /cycle_data, e.g. { "max_age_seconds": 0 } (0: always revalidate)
+http_cache_flags = load_flags_json("HTTP_CACHE_FLAGS_JSON")
+http_cache_max_age = int(http_cache_flags.get("max_age_seconds", 0))
+
+# Bulk endpoints span many users and take service tokens (python -m app.auth) instead of user tokens
+require_admin = require_scope(ADMIN_SCOPE)
+
+# Background training queue, e.g. { "workers": 2, "max_pending": 1000, "debounce_seconds": 300 }
+training_queue_flags = load_flags_json("TRAINING_QUEUE_FLAGS_JSON")
+training_queue = TrainingQueue(
+    observe_training("queue", train_with_feedback),
+    workers=training_queue_flags.get("workers", 2),
+    max_pending=training_queue_flags.get("max_pending", 1000),
+    debounce_seconds=training_queue_flags.get("debounce_seconds", 300),
+)
 
 
 @asynccontextmanager
@@ -47,10 +98,13 @@ async def lifespan(app: FastAPI):
     logging.info("FastAPI app startup event triggered.")
     if scheduler_enabled:
         logging.info("Scheduler is enabled. Starting scheduler...")
-        start_scheduler()
+        start_scheduler(max_workers=scheduler_flags.get("retrain_workers", 4))
     else:
         logging.info("Scheduler is disabled by feature flag.")
+    training_queue.start()
     yield
+    logging.info("FastAPI app shutdown: draining training queue...")
+    training_queue.shutdown(drain=True, timeout=training_queue_flags.get("shutdown_timeout_seconds", 30))
 
 
 # Fix for CORS preflight and error responses
@@ -64,7 +118,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets browser clients read the ETag for If-None-Match polling
+    expose_headers=["ETag"],
 )
+# Outermost, so latency covers the whole stack and CORS preflights are counted too
+app.add_middleware(MetricsMiddleware)
+
+# Manual /train jobs, timed apart from queued and scheduled training
+train_manual = observe_training("manual", train_with_feedback)
 
 # Pydantic models for request validation
 
@@ -91,46 +152,53 @@ class SecurityAnswerRequest(BaseModel):
 class AddCycleDateRequest(BaseModel):
     date: str
 
+
+class BatchPredictRequest(BaseModel):
+    usernames: List[str]
+    top_n: int = 3
+
+
+class FeedbackBatchRequest(BaseModel):
+    # Each entry: {"username", "actual_date", optional "predicted_date" and "comment"}
+    entries: List[dict]
+
+# ETags of the per-user GET endpoints are derived from the cycle document's update time
+PREDICT_ETAG_KIND = f"predict:{PREDICT_ETAG_VERSION}"
+CYCLE_DATA_ETAG_KIND = "cycle_data"
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, http_cache_max_age))
+
+
+def _validated_date(value, field: str) -> str:
+    """The date normalized to YYYY-MM-DD, as stored; 400 when it is not a valid ISO date."""
+    try:
+        return normalize_date(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{field} must be an ISO date (YYYY-MM-DD)")
+
+
 # Add a new cycle date for a user
-@app.post("/add-cycle-date/{username}")
-def add_cycle_date(username: str, req: AddCycleDateRequest = Body(...)):
-    from firebase_admin import firestore
-    db = firestore.client()
-    date = req.date
-    if not date:
+@app.post("/add-cycle-date/{username}", dependencies=[Depends(require_user)])
+async def add_cycle_date(username: str, req: AddCycleDateRequest = Body(...)):
+    if not req.date:
         raise HTTPException(status_code=400, detail="Date is required")
-    doc_ref = db.collection("menstrual_data").document(username)
-    doc = doc_ref.get()
-    if doc.exists:
-        data = doc.to_dict() or {}
-        numeric_keys = [int(k) for k in data.keys() if k.isdigit()]
-        next_key = str(max(numeric_keys) + 1) if numeric_keys else "1"
-        doc_ref.update({next_key: date})
-    else:
-        doc_ref.set({"1": date})
+    await add_cycle_date_async(username, _validated_date(req.date, "date"))
     return {"message": "Cycle date added successfully."}
 
 @app.post("/register")
-def register(credentials: RegisterCredentials):
+async def register(credentials: RegisterCredentials):
     logging.info(
         f"Received registration request for username: {credentials.username}")
-    # Pass security question and answer to user_service
-    # Pass as extra args using a wrapper function
-    # Instead of using frame hacks, pass security question/answer as global variables for this call
-    # Use a global dict for passing security question/answer for this call
-    import sys
-    main_mod = sys.modules[__name__]
-    setattr(main_mod, '_SECURITY_CONTEXT', {
-        'security_question': credentials.securityQuestion,
-        'security_answer': credentials.securityAnswer,
-    })
-    try:
-        result = create_user(
-            credentials.username,
-            credentials.password,
-        )
-    finally:
-        setattr(main_mod, '_SECURITY_CONTEXT', None)
+    # Pass security question and answer explicitly: a module-level context would be
+    # shared between registrations interleaved on the event loop
+    result = await create_user_async(
+        credentials.username,
+        credentials.password,
+        security_question=credentials.securityQuestion,
+        security_answer=credentials.securityAnswer,
+    )
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["error"])
     return {"message": "User registered successfully"}
@@ -138,18 +206,16 @@ def register(credentials: RegisterCredentials):
 
 # Password recovery endpoints
 @app.get("/security-question/{username}")
-def get_security_question_endpoint(username: str):
-    from app.user_service import get_security_question
-    result = get_security_question(username)
+async def get_security_question_endpoint(username: str):
+    result = await get_security_question_async(username)
     if not result["success"]:
         raise HTTPException(status_code=404, detail=result["error"])
     return {"securityQuestion": result["securityQuestion"]}
 
 
 @app.post("/reset-password")
-def reset_password(req: SecurityAnswerRequest):
-    from app.user_service import verify_security_answer_and_reset
-    result = verify_security_answer_and_reset(
+async def reset_password(req: SecurityAnswerRequest):
+    result = await verify_security_answer_and_reset_async(
         req.username, req.securityAnswer, req.newPassword)
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["error"])
@@ -160,104 +226,242 @@ def reset_password(req: SecurityAnswerRequest):
 
 
 def trigger_training_bg(username):
-    def train_bg():
-        try:
-            train_with_feedback(username)
-        except Exception as e:
-            logging.error(f"Background training failed for {username}: {e}")
-    threading.Thread(target=train_bg, daemon=True).start()
+    status = training_queue.submit(username)
+    logging.info(f"Background training for {username}: {status}")
+    return status
+
+
+@app.get("/cycle-store/stats")
+async def cycle_store_stats():
+    return cycle_store.stats()
+
+
+@app.get("/single-flight/stats")
+async def single_flight_stats():
+    return {"cycle_data": cycle_reads.stats(), "users": user_reads.stats()}
+
+
+@app.get("/auth/stats")
+async def auth_stats():
+    return sessions.stats()
+
+
+@app.get("/training-queue/stats")
+async def training_queue_stats():
+    return training_queue.stats()
 
 
 @app.post("/login")
-def login(credentials: LoginCredentials):
+async def login(credentials: LoginCredentials):
     logging.info(
         f"Received login request for username: {credentials.username}")
-    result = validate_login(credentials.username, credentials.password)
+    result = await validate_login_async(credentials.username, credentials.password)
     if not result["success"]:
         raise HTTPException(status_code=401, detail=result["error"])
     # Trigger training in the background after successful login
     trigger_training_bg(credentials.username)
+    # Later requests authenticate with this token, verified in-process without a storage read
     return {
         "message": "Login successful",
-        "username": credentials.username
+        "username": credentials.username,
+        **sessions.issue(credentials.username),
     }
 
 
-@app.get("/predict/{username}")
-def predict(username: str):
+@app.get("/predict/{username}", dependencies=[Depends(require_user)])
+async def predict(username: str, request: Request, response: Response):
     logging.info(f"Received /predict request for user: {username}")
     collection_name = get_user_collection(username)
     if not collection_name:
         raise HTTPException(status_code=404, detail="User not found")
-
-    dates = fetch_cycle_data(collection_name)
-    from app.model import predict_next_dates
-    top_dates = predict_next_dates(dates, top_n=3)
-    result = {
-        "top_dates": [str(d) for d in top_dates],
-        "next_date": str(top_dates[0]) if top_dates else None
-    }
+    if_none_match = request.headers.get("if-none-match")
+
+    cached = prediction_cache.get(collection_name)
+    if cached is not None:
+        result, update_time = cached
+        etag = etag_for(PREDICT_ETAG_KIND, collection_name, update_time)
+        if etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        logging.info(f"Prediction cache hit for user {username}: {result}")
+        response.headers.update(cache_headers(etag, http_cache_max_age))
+        return result
+
+    if if_none_match:
+        # Revalidation from the cycle store or a metadata-only read; no prediction when unchanged
+        etag = etag_for(PREDICT_ETAG_KIND, collection_name, await fetch_cycle_update_time_async(collection_name))
+        if etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+
+    token = prediction_cache.token(collection_name)
+    history = await fetch_cycle_history_async(collection_name)
+    from app.model import predict_from_state
+    # Only the user's small model state is needed; it carries the confidence band as well
+    with PREDICT_DURATION.labels("single").time():
+        result = predict_from_state(history.model_state, top_n=3)
+    prediction_cache.put(collection_name, result, history.update_time, token=token)
     logging.info(f"Prediction result for user {username}: {result}")
+    response.headers.update(cache_headers(etag_for(PREDICT_ETAG_KIND, collection_name, history.update_time),
+                                          http_cache_max_age))
     return result
 
 
-@app.post("/feedback/{username}")
-def feedback(username: str, data: dict):
+@app.get("/metrics")
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/prediction-cache/stats")
+async def prediction_cache_stats():
+    return prediction_cache.stats()
+
+
+@app.get("/forecast-cache/stats")
+async def forecast_cache_stats():
+    return forecast_cache.stats()
+
+
+@app.get("/forecast/{username}", dependencies=[Depends(require_user)])
+async def forecast(username: str, cycles: int = 6):
+    """The next `cycles` projected cycles, each with a start-date band that widens further ahead."""
+    from app.model import FORECAST_HORIZON_CYCLES
+    if not 1 <= cycles <= FORECAST_HORIZON_CYCLES:
+        raise HTTPException(status_code=400, detail=f"cycles must be between 1 and {FORECAST_HORIZON_CYCLES}")
+    projection = await fetch_forecast_async(get_user_collection(username))
+    horizon_end = projection.horizon_end
+    return {"cycles": projection.cycles(cycles), "horizon_end": str(horizon_end) if horizon_end else None}
+
+
+@app.get("/forecast/{username}/month/{year}/{month}", dependencies=[Depends(require_user)])
+async def forecast_month(username: str, year: int, month: int, threshold: float = 0.5):
+    """Probability that each day of the month is a period day, sliced from the memoized projection."""
+    if not 1 <= month <= 12 or not 1 <= year <= 9998:
+        raise HTTPException(status_code=400, detail="Invalid year or month")
+    projection = await fetch_forecast_async(get_user_collection(username))
+    days, probabilities = projection.month(year, month)
+    probabilities = [round(p, 3) for p in probabilities.tolist()]
+    return {
+        "year": year,
+        "month": month,
+        "days": [{"date": str(d), "probability": p} for d, p in zip(days, probabilities)],
+        "likely_days": [str(d) for d, p in zip(days, probabilities) if p >= threshold],
+    }
+
+
+@app.post("/predict/batch", dependencies=[Depends(require_admin)])
+async def predict_batch(req: BatchPredictRequest):
+    logging.info(f"Received /predict/batch request for {len(req.usernames)} users")
+    histories = await fetch_cycle_histories_batch_async(req.usernames)
+    from app.model import to_ragged_days, predict_next_dates_batch
+    with PREDICT_DURATION.labels("batch").time():
+        values, offsets = to_ragged_days(list(histories.values()))
+        predictions = predict_next_dates_batch(values, offsets, top_n=req.top_n)
+    results = {}
+    for username, top_dates in zip(histories, predictions):
+        results[username] = {
+            "top_dates": [str(d) for d in top_dates],
+            "next_date": str(top_dates[0]) if top_dates else None
+        }
+    logging.info(f"Batch prediction completed for {len(results)} users")
+    return {"predictions": results}
+
+
+@app.post("/import/cycle-dates", dependencies=[Depends(require_admin)])
+async def import_cycle_dates(request: Request, format: str = "ndjson"):
+    """
+    Bulk import of (username, date) rows streamed in the request body as NDJSON or CSV (?format=csv).
+    The body is parsed as it arrives; see app/bulk_import.py for batching and retries.
+    """
+    from app.bulk_import import FORMATS, aiter_lines, import_lines_async
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format; expected one of {', '.join(FORMATS)}")
+    logging.info(f"Received /import/cycle-dates request (format={format})")
+    return await import_lines_async(aiter_lines(request.stream()), fmt=format)
+
+
+@app.get("/export/{dataset}", dependencies=[Depends(require_admin)])
+async def export_dataset(dataset: str, format: str = "ndjson", cursor: str = None, page_size: int = 500):
+    """
+    Stream cycle_data or feedback as NDJSON (or Parquet with ?format=parquet, needs pyarrow), paging
+    through storage so the API never holds the whole dataset. Pass a line's "cursor" to resume after it.
+    """
+    from fastapi.responses import StreamingResponse
+    from app.export import export, parquet_available
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="Parquet export requires pyarrow")
+    try:
+        chunks = export(dataset, format, cursor=cursor, page_size=page_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logging.info(f"Streaming {dataset} export (format={format}, resumed={bool(cursor)})")
+    media_type = "application/vnd.apache.parquet" if format == "parquet" else "application/x-ndjson"
+    # The generator reads storage synchronously; StreamingResponse iterates it in the threadpool
+    return StreamingResponse(chunks, media_type=media_type)
+
+
+# Declared before /feedback/{username} so "batch" is not taken for a username
+@app.post("/feedback/batch", dependencies=[Depends(require_admin)])
+async def feedback_batch(req: FeedbackBatchRequest):
+    logging.info(f"Received /feedback/batch request with {len(req.entries)} entries")
+    # Each user's reported dates correct the nearest stored date within 7 days or are added
+    return await store_feedback_batch_async(req.entries)
+
+
+@app.post("/feedback/{username}", dependencies=[Depends(require_user)])
+async def feedback(username: str, data: dict):
     logging.info(f"Received feedback from user {username}: {data}")
+    actual_date = data.get("actual_date")
+    if actual_date:
+        actual_date = _validated_date(actual_date, "actual_date")
     # Compose a detailed log document name and structure
     from datetime import datetime
-    from firebase_admin import firestore
-    db = firestore.client()
     now = datetime.now(tz=ZoneInfo('Asia/Kolkata')).strftime('%Y-%b-%d-%H-%M-%S')
     doc_name = f"{username}_{now}"
     log_data = {
         "username": username,
         "timestamp": now,
         "predicted_date": data.get("predicted_date"),
-        "actual_date": data.get("actual_date"),
+        "actual_date": actual_date,
         "comment": data.get("comment", "")
     }
-    db.collection("prediction_feedback").document(doc_name).set(log_data)
+    await log_prediction_feedback_async(doc_name, log_data)
 
-    # Also add actual_date to menstrual_data collection as next numeric key
-    actual_date = data.get("actual_date")
+    # Also append actual_date to the user's menstrual_data history
     if actual_date:
-        menstrual_doc_ref = db.collection("menstrual_data").document(username)
-        menstrual_doc = menstrual_doc_ref.get()
-        if menstrual_doc.exists:
-            menstrual_data = menstrual_doc.to_dict() or {}
-            # Find next numeric key
-            numeric_keys = [int(k)
-                            for k in menstrual_data.keys() if k.isdigit()]
-            next_key = str(max(numeric_keys) + 1) if numeric_keys else "1"
-        else:
-            next_key = "1"
-        menstrual_doc_ref.update({next_key: actual_date}) if menstrual_doc.exists else menstrual_doc_ref.set(
-            {next_key: actual_date})
+        await add_cycle_date_async(username, actual_date)
 
     return {"message": "Feedback received and stored."}
 
 
-@app.post("/train/{username}")
-def train(username: str):
+@app.post("/train/{username}", dependencies=[Depends(require_user)])
+async def train(username: str):
     logging.info(
         f"Received /train request for user: {username}. Training model manually.")
     collection_name = get_user_collection(username)
     if not collection_name:
         raise HTTPException(status_code=404, detail="User not found")
 
-    success = train_with_feedback(collection_name)
+    # Training uses the sync data path; keep it off the event loop
+    success = await run_in_threadpool(train_manual, collection_name)
     if success:
         return {"message": "Model trained successfully with feedback."}
     else:
         return {"message": "Not enough data to train the model."}
 
 
-@app.get("/cycle_data/{username}")
-def cycle_data(username: str):
+@app.get("/cycle_data/{username}", dependencies=[Depends(require_user)])
+async def cycle_data(username: str, request: Request, response: Response):
     collection_name = get_user_collection(username)
     if not collection_name:
         raise HTTPException(status_code=404, detail="User not found")
+    if_none_match = request.headers.get("if-none-match")
+
+    if if_none_match:
+        etag = etag_for(CYCLE_DATA_ETAG_KIND, collection_name, await fetch_cycle_update_time_async(collection_name))
+        if etag_matches(if_none_match, etag):
+            return _not_modified(etag)
 
-    dates = fetch_cycle_data(collection_name)
-    return {"dates": dates}
+    history = await fetch_cycle_history_async(collection_name)
+    response.headers.update(cache_headers(etag_for(CYCLE_DATA_ETAG_KIND, collection_name, history.update_time),
+                                          http_cache_max_age))
+    return {"dates": history.iso_dates()}
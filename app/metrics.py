@@ -0,0 +1,139 @@
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Prometheus metrics served at /metrics. Everything here is cheap enough to leave on permanently
+# (a few microseconds per observation; see benchmarks/metrics_overhead.py). Route labels use the
+# route template (e.g. /predict/{username}), never the raw path, to keep label cardinality bounded.
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served.")
+
+STORAGE_LATENCY = Histogram(
+    "storage_operation_duration_seconds", "Latency of storage backend operations (Firestore or SQLite calls).",
+    ["operation"],
+)
+STORAGE_ERRORS = Counter("storage_operation_errors_total", "Storage backend operations that raised.", ["operation"])
+# Set while an observed operation runs, so operations it calls internally are not counted again
+_in_storage_operation = ContextVar("in_storage_operation", default=False)
+SINGLE_FLIGHT_COALESCED = Counter(
+    "single_flight_coalesced_total", "Reads that shared another request's in-flight read.", ["group"],
+)
+
+TRAINING_DURATION = Histogram(
+    "training_job_duration_seconds", "Duration of per-user training jobs.", ["source"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+TRAINING_FAILURES = Counter("training_job_failures_total", "Training jobs that raised.", ["source"])
+RETRAIN_RUN_DURATION = Histogram(
+    "scheduled_retrain_run_seconds", "Duration of full scheduled retraining runs.",
+    buckets=(1, 10, 30, 60, 300, 900, 1800, 3600, 7200),
+)
+
+PREDICT_DURATION = Histogram(
+    "predict_duration_seconds", "Time spent computing predictions (excluding data access).", ["kind"],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+)
+
+
+def observe_storage(operation: str):
+    """
+    Decorator recording latency and errors of a sync or async storage operation. Only the outermost
+    observed call is recorded; operations nested inside it are part of its latency.
+    """
+    latency = STORAGE_LATENCY.labels(operation)
+    errors = STORAGE_ERRORS.labels(operation)
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if _in_storage_operation.get():
+                    return await fn(*args, **kwargs)
+                token = _in_storage_operation.set(True)
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    latency.observe(time.perf_counter() - start)
+                    _in_storage_operation.reset(token)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _in_storage_operation.get():
+                return fn(*args, **kwargs)
+            token = _in_storage_operation.set(True)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - start)
+                _in_storage_operation.reset(token)
+        return wrapper
+    return decorator
+
+
+def observe_training(source: str, fn):
+    """Wrap a training function so each job's duration and failures are recorded under `source`."""
+    duration = TRAINING_DURATION.labels(source)
+    failures = TRAINING_FAILURES.labels(source)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            failures.inc()
+            raise
+        finally:
+            duration.observe(time.perf_counter() - start)
+    return wrapper
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no per-request task or body buffering) recording route latency and in-flight requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # The router stores the matched route in the scope; unmatched paths share one label
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(scope["method"], getattr(route, "path", "unmatched"), str(status)).observe(
+                time.perf_counter() - start)
+
+
+def render_metrics():
+    """(body, content_type) for the /metrics response."""
+    return generate_latest(), CONTENT_TYPE_LATEST
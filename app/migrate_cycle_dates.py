@@ -0,0 +1,75 @@
+"""
+One-shot migration of menstrual_data documents from serial-number fields ("1", "2", ...)
+to the "dates" array layout. Safe to re-run; fetch_cycle_data reads both layouts meanwhile.
+
+Usage: python -m app.migrate_cycle_dates [--dry-run] [--batch-size 500]
+"""
+import argparse
+import logging
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition
+from app.firestore_storage import get_db
+from app.storage import CYCLE_DATA, DATES_FIELD, cycle_dates, legacy_keys
+
+# Firestore allows at most 500 writes per batch
+MAX_BATCH_SIZE = 500
+
+
+def _migration_update(data: dict) -> dict:
+    update = {DATES_FIELD: cycle_dates(data)}
+    update.update({k: firestore.DELETE_FIELD for k in legacy_keys(data)})
+    return update
+
+
+@firestore.transactional
+def _migrate_in_transaction(transaction, doc_ref):
+    snapshot = doc_ref.get(transaction=transaction)
+    data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    if legacy_keys(data):
+        transaction.update(doc_ref, _migration_update(data))
+
+
+def _commit(batch_docs):
+    # Each update is conditioned on the update time we read, so a concurrent append fails the
+    # batch instead of being overwritten; those documents are then migrated one by one in transactions.
+    db = get_db()
+    batch = db.batch()
+    for doc in batch_docs:
+        batch.update(doc.reference, _migration_update(doc.to_dict() or {}),
+                     option=db.write_option(last_update_time=doc.update_time))
+    try:
+        batch.commit()
+    except FailedPrecondition:
+        logging.warning(f"Batch of {len(batch_docs)} documents changed during migration; retrying individually.")
+        for doc in batch_docs:
+            _migrate_in_transaction(db.transaction(), doc.reference)
+
+
+def migrate(dry_run: bool = False, batch_size: int = MAX_BATCH_SIZE) -> dict:
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    stats = {"scanned": 0, "migrated": 0}
+    pending = []
+    for doc in get_db().collection(CYCLE_DATA).stream():
+        stats["scanned"] += 1
+        if not legacy_keys(doc.to_dict() or {}):
+            continue
+        stats["migrated"] += 1
+        if dry_run:
+            continue
+        pending.append(doc)
+        if len(pending) == batch_size:
+            _commit(pending)
+            pending = []
+    if pending:
+        _commit(pending)
+    logging.info(f"Cycle date migration {'(dry run) ' if dry_run else ''}finished: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser(description="Migrate menstrual_data documents to the dates array layout.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count documents that need migrating.")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE)
+    args = parser.parse_args()
+    migrate(dry_run=args.dry_run, batch_size=args.batch_size)
@@ -1,41 +1,348 @@
-import pandas as pd
-from datetime import timedelta
+import math
+import sys
+from array import array
+
 import numpy as np
+from app.cycle_store import CycleHistory, from_day, to_day
 
 def train_model(dates):
-    # No longer needed for rolling average, but kept for compatibility
-    return True
+    """Build the online model state from ISO dates; None when there are fewer than 2 valid dates."""
+    state = CycleModelState.from_days(CycleHistory.from_dates(dates).days)
+    return state if state.count >= 2 else None
 
-def predict_next_dates(dates, top_n=3):
-    dates = pd.to_datetime(dates)
-    if len(dates) < 2:
+def predict_from_days(days, top_n=3):
+    """predict_next_dates on an array of days since the epoch (e.g. CycleHistory.to_numpy())."""
+    if len(days) < 2:
         return []
-    intervals = (dates[1:] - dates[:-1]).days
-    intervals = np.array(intervals)
-    # Use last 3 intervals for rolling average, but also consider min/max for alternatives
-    if len(intervals) >= 3:
-        last_intervals = intervals[-3:]
-    else:
-        last_intervals = intervals
+    intervals = np.diff(np.asarray(days, dtype=np.int64))
+    last_intervals = intervals[-3:]
     avg_interval = int(round(last_intervals.mean()))
-    min_interval = int(np.floor(last_intervals.min()))
-    max_interval = int(np.ceil(last_intervals.max()))
+    min_interval = int(last_intervals.min())
+    max_interval = int(last_intervals.max())
+    last = int(days[-1])
     # Most confident: average, then min, then max
-    next_dates = [dates[-1] + timedelta(days=avg_interval)]
+    next_days = [last + avg_interval]
     if min_interval != avg_interval:
-        next_dates.append(dates[-1] + timedelta(days=min_interval))
+        next_days.append(last + min_interval)
     if max_interval != avg_interval and max_interval != min_interval:
-        next_dates.append(dates[-1] + timedelta(days=max_interval))
-    # Return up to top_n unique dates
-    unique_dates = []
-    for d in next_dates:
-        if d.date() not in unique_dates:
-            unique_dates.append(d.date())
-        if len(unique_dates) == top_n:
-            break
-    return unique_dates
+        next_days.append(last + max_interval)
+    return [from_day(d) for d in next_days[:top_n]]
+
+
+def predict_next_dates(dates, top_n=3):
+    if isinstance(dates, CycleHistory):
+        return predict_from_days(dates.to_numpy(), top_n=top_n)
+    # ISO strings are parsed by NumPy (no pandas on the prediction path); order is kept as given
+    days = np.array(dates, dtype="datetime64[D]").astype(np.int64)
+    return predict_from_days(days, top_n=top_n)
 
 def predict_next_date(dates):
     # For compatibility, return the most confident date
     top_dates = predict_next_dates(dates, top_n=1)
     return top_dates[0] if top_dates else None
+
+def to_ragged_days(histories):
+    """
+    Pack many users' date histories (ISO date lists or CycleHistory objects) into a ragged int array.
+    Returns (values, offsets): values holds days since the epoch for every user back to back,
+    and user i's history is values[offsets[i]:offsets[i + 1]].
+    """
+    lengths = np.fromiter((len(h) for h in histories), dtype=np.int64, count=len(histories))
+    offsets = np.zeros(len(histories) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if all(isinstance(h, CycleHistory) for h in histories):
+        # Already parsed: concatenate the int32 buffers without touching strings
+        if not offsets[-1]:
+            return np.empty(0, dtype=np.int64), offsets
+        return np.concatenate([h.to_numpy() for h in histories]).astype(np.int64), offsets
+    flat = [d for h in histories for d in h]
+    values = np.array(flat, dtype="datetime64[D]").astype(np.int64) if flat else np.empty(0, dtype=np.int64)
+    return values, offsets
+
+
+def predict_next_dates_batch(values, offsets, top_n=3):
+    """
+    Vectorized predict_next_dates over a ragged array of day offsets (see to_ragged_days).
+    Returns one list of up to top_n dates per user, matching predict_next_dates.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_users = len(offsets) - 1
+    results = [[] for _ in range(n_users)]
+    lengths = np.diff(offsets)
+    users = np.flatnonzero(lengths >= 2)
+    if len(users) == 0 or top_n <= 0:
+        return results
+
+    ends = offsets[users + 1] - 1
+    n_intervals = lengths[users] - 1
+    # Last (up to) 3 intervals per user, NaN where the history is shorter
+    window = np.full((len(users), 3), np.nan)
+    for j in range(3):
+        valid = n_intervals > j
+        idx = ends[valid] - j
+        window[valid, j] = values[idx] - values[idx - 1]
+    avg_interval = np.rint(np.nanmean(window, axis=1)).astype(np.int64)
+    min_interval = np.nanmin(window, axis=1).astype(np.int64)
+    max_interval = np.nanmax(window, axis=1).astype(np.int64)
+
+    # Most confident: average, then min, then max
+    last = values[ends]
+    candidates = np.stack([last + avg_interval, last + min_interval, last + max_interval], axis=1)
+    keep = np.stack([
+        np.ones(len(users), dtype=bool),
+        min_interval != avg_interval,
+        (max_interval != avg_interval) & (max_interval != min_interval),
+    ], axis=1)
+    candidate_dates = candidates.astype("datetime64[D]").tolist()
+    keep = keep.tolist()
+    for row, user in enumerate(users.tolist()):
+        results[user] = [d for d, k in zip(candidate_dates[row], keep[row]) if k][:top_n]
+    return results
+
+
+# --- Online per-user model ---
+# Updated in O(1) per appended date and persisted in the user's cycle document (storage.MODEL_STATE_FIELD).
+
+# Intervals kept for the avg/min/max candidates; matches predict_from_days
+STATE_WINDOW = 3
+# Smoothing factor of the exponentially weighted cycle-length mean/variance
+EWMA_ALPHA = 0.3
+# z-score of the two-sided ~90% confidence band around the expected next date
+CONFIDENCE_Z = 1.645
+# Floor on the cycle-length spread so short or perfectly regular histories still get a band
+MIN_STD_DAYS = 1.0
+
+
+class CycleModelState:
+    """
+    Rolling cycle statistics for one user: last date, the most recent intervals, and an
+    EWMA mean/variance of cycle length. count and last_day let a persisted state be checked
+    against the user's history; a state that does not match is rebuilt with from_days.
+    """
+
+    __slots__ = ("last_day", "count", "intervals", "mean", "var")
+
+    def __init__(self, last_day=None, count=0, intervals=(), mean=0.0, var=0.0):
+        self.last_day = last_day
+        self.count = count
+        self.intervals = list(intervals)
+        self.mean = mean
+        self.var = var
+
+    @classmethod
+    def from_days(cls, days):
+        """Build the state from sorted, de-duplicated days (e.g. CycleHistory.days)."""
+        state = cls()
+        for day in days:
+            state.append(int(day))
+        return state
+
+    def append(self, day: int) -> bool:
+        """
+        Add a date in O(1). Returns False when day falls before the last date, in which case
+        the state is left unchanged and must be rebuilt from the full history.
+        """
+        if self.last_day is not None:
+            if day < self.last_day:
+                return False
+            if day == self.last_day:
+                return True
+            interval = day - self.last_day
+            self.intervals = (self.intervals + [interval])[-STATE_WINDOW:]
+            if self.count == 1:
+                self.mean = float(interval)
+            else:
+                # Incremental exponentially weighted mean and variance
+                diff = interval - self.mean
+                increment = EWMA_ALPHA * diff
+                self.mean += increment
+                self.var = (1 - EWMA_ALPHA) * (self.var + diff * increment)
+        self.last_day = day
+        self.count += 1
+        return True
+
+    def matches(self, history) -> bool:
+        """True when this state was built from exactly the given CycleHistory's dates."""
+        if self.count != len(history):
+            return False
+        return self.count == 0 or self.last_day == history.days[-1]
+
+    def predict(self, top_n=3):
+        """Same candidates as predict_from_days (average, min, max of the recent intervals)."""
+        if self.count < 2:
+            return []
+        avg_interval = int(round(sum(self.intervals) / len(self.intervals)))
+        min_interval = min(self.intervals)
+        max_interval = max(self.intervals)
+        next_days = [self.last_day + avg_interval]
+        if min_interval != avg_interval:
+            next_days.append(self.last_day + min_interval)
+        if max_interval != avg_interval and max_interval != min_interval:
+            next_days.append(self.last_day + max_interval)
+        return [from_day(d) for d in next_days[:top_n]]
+
+    def std(self) -> float:
+        return max(self.var ** 0.5, MIN_STD_DAYS)
+
+    def confidence_band(self):
+        """(lower, upper) dates of the ~90% band for the next cycle start, or None with fewer than 2 dates."""
+        if self.count < 2:
+            return None
+        spread = CONFIDENCE_Z * self.std()
+        return (from_day(self.last_day + int(np.floor(self.mean - spread))),
+                from_day(self.last_day + int(np.ceil(self.mean + spread))))
+
+    def to_dict(self) -> dict:
+        return {
+            "last_date": from_day(self.last_day).isoformat() if self.last_day is not None else None,
+            "count": self.count,
+            "intervals": list(self.intervals),
+            "mean": self.mean,
+            "var": self.var,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Parse a persisted state; returns None when it is missing or malformed."""
+        if not isinstance(data, dict):
+            return None
+        try:
+            last_date = data.get("last_date")
+            return cls(
+                last_day=to_day(last_date) if last_date else None,
+                count=int(data["count"]),
+                intervals=[int(i) for i in data.get("intervals") or []][-STATE_WINDOW:],
+                mean=float(data.get("mean", 0.0)),
+                var=float(data.get("var", 0.0)),
+            )
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def to_array(self) -> array:
+        """
+        Packed form held by CycleHistory: last_day, count, STATE_WINDOW intervals (NaN-padded at
+        the front), mean, var as doubles, about 120 bytes against about 230 for the object.
+        """
+        padding = [math.nan] * (STATE_WINDOW - len(self.intervals))
+        last_day = math.nan if self.last_day is None else self.last_day
+        return array("d", [last_day, self.count, *padding, *self.intervals, self.mean, self.var])
+
+    @classmethod
+    def from_array(cls, values):
+        last_day, count = values[0], values[1]
+        return cls(
+            last_day=None if math.isnan(last_day) else int(last_day),
+            count=int(count),
+            intervals=[int(i) for i in values[2:2 + STATE_WINDOW] if not math.isnan(i)],
+            mean=values[2 + STATE_WINDOW],
+            var=values[3 + STATE_WINDOW],
+        )
+
+
+def predict_from_state(state: CycleModelState, top_n=3) -> dict:
+    """Prediction response for /predict from the model state alone."""
+    top_dates = state.predict(top_n=top_n)
+    band = state.confidence_band()
+    return {
+        "top_dates": [str(d) for d in top_dates],
+        "next_date": str(top_dates[0]) if top_dates else None,
+        "confidence_band": {"lower": str(band[0]), "upper": str(band[1])} if band else None,
+        "cycle_length": {"mean": round(state.mean, 2), "std": round(state.std(), 2)} if band else None,
+    }
+
+
+# --- Multi-cycle forecast ---
+
+# Cycles projected ahead of the last recorded date (about two years)
+FORECAST_HORIZON_CYCLES = 24
+# Assumed period length when marking likely period days
+PERIOD_LENGTH_DAYS = 5
+# Plausible cycle-length range and spread used for projection. Histories with large gaps (e.g. two
+# dates years apart) would otherwise stretch the day grid to hundreds of thousands of days
+MIN_FORECAST_CYCLE_DAYS = 15
+MAX_FORECAST_CYCLE_DAYS = 90
+MAX_FORECAST_STD_DAYS = 30.0
+
+
+def _normal_cdf(x):
+    """Standard normal CDF via the Abramowitz-Stegun erf approximation (error < 1.5e-7), vectorized."""
+    z = np.abs(x) / np.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1.0 - poly * np.exp(-z * z)
+    return 0.5 * (1.0 + np.sign(x) * erf)
+
+
+class CycleForecast:
+    """
+    Projection of a user's next cycles from the model state. Cycle k starts around last date +
+    k * mean cycle length, with a spread that grows as std * sqrt(k) (independent cycle lengths).
+    The probability that each day from the last recorded start to the end of the horizon is a
+    period day is computed once, in one vectorized pass over days x cycles, so month queries are
+    array slices. The mean and spread are clamped to a plausible range, which bounds the grid to
+    about horizon x MAX_FORECAST_CYCLE_DAYS days.
+    """
+
+    __slots__ = ("first_day", "means", "stds", "probabilities", "period_length", "update_time")
+
+    def __init__(self, state: CycleModelState, horizon: int = FORECAST_HORIZON_CYCLES,
+                 period_length: int = PERIOD_LENGTH_DAYS, update_time=None):
+        self.period_length = period_length
+        # Update time of the cycle document the forecast was built from
+        self.update_time = update_time
+        if state.count < 2:
+            self.first_day = None
+            self.means = self.stds = np.empty(0)
+            self.probabilities = np.empty(0, dtype=np.float32)
+            return
+        k = np.arange(1, horizon + 1)
+        self.first_day = state.last_day
+        mean = min(max(state.mean, MIN_FORECAST_CYCLE_DAYS), MAX_FORECAST_CYCLE_DAYS)
+        self.means = state.last_day + k * mean
+        self.stds = min(state.std(), MAX_FORECAST_STD_DAYS) * np.sqrt(k)
+        last_day = int(np.ceil(self.means[-1] + CONFIDENCE_Z * self.stds[-1])) + period_length
+        # Offsets of each day from each projected start; +0.5 so a start on day d counts for d
+        days = np.arange(self.first_day, last_day + 1, dtype=np.float64)[:, None]
+        starts_by = _normal_cdf((days + 0.5 - self.means) / self.stds)
+        starts_before = _normal_cdf((days + 0.5 - period_length - self.means) / self.stds)
+        probabilities = np.clip((starts_by - starts_before).sum(axis=1), 0.0, 1.0)
+        # The recorded period itself
+        probabilities[:period_length] = 1.0
+        self.probabilities = probabilities.astype(np.float32)
+
+    @property
+    def horizon_end(self):
+        return from_day(self.first_day + len(self.probabilities) - 1) if self.first_day is not None else None
+
+    def cycles(self, n: int) -> list:
+        """The next n projected cycles with their ~90% bands for the start date."""
+        n = min(n, len(self.means))
+        means, stds = self.means[:n], self.stds[:n]
+        starts = np.rint(means).astype(np.int64)
+        lowers = np.floor(means - CONFIDENCE_Z * stds).astype(np.int64)
+        uppers = np.ceil(means + CONFIDENCE_Z * stds).astype(np.int64)
+        return [{
+            "cycle": i + 1,
+            "start": str(from_day(start)),
+            "period_end": str(from_day(start + self.period_length - 1)),
+            "lower": str(from_day(lower)),
+            "upper": str(from_day(upper)),
+            "std_days": round(float(std), 2),
+        } for i, (start, lower, upper, std) in enumerate(zip(starts.tolist(), lowers.tolist(),
+                                                               uppers.tolist(), stds.tolist()))]
+
+    def month(self, year: int, month: int):
+        """(dates, probabilities) of every day in the month; days outside the forecast are 0."""
+        first = to_day(f"{year:04d}-{month:02d}-01")
+        next_first = to_day(f"{year + month // 12:04d}-{month % 12 + 1:02d}-01")
+        probabilities = np.zeros(next_first - first, dtype=np.float32)
+        if self.first_day is not None:
+            lo = max(first - self.first_day, 0)
+            hi = min(next_first - self.first_day, len(self.probabilities))
+            if lo < hi:
+                probabilities[lo + self.first_day - first:hi + self.first_day - first] = self.probabilities[lo:hi]
+        return [from_day(d) for d in range(first, next_first)], probabilities
+
+    def nbytes(self) -> int:
+        return self.means.nbytes + self.stds.nbytes + self.probabilities.nbytes + sys.getsizeof(self)
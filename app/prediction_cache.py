@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.invalidation import InvalidationVersions
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL_SECONDS = 3600
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of per-user prediction results.
+    Each entry stores the /predict result together with the menstrual_data document's update time.
+    Writes to a user's cycle data must call invalidate(username), which bumps only that user's
+    version, so a write for one user never discards another user's concurrent put.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = InvalidationVersions()
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_size: int = None, ttl_seconds: float = None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = int(max_size)
+            if ttl_seconds is not None:
+                self.ttl_seconds = float(ttl_seconds)
+            self._evict()
+        logging.info(f"Prediction cache configured: max_size={self.max_size}, ttl_seconds={self.ttl_seconds}")
+
+    def token(self, username: str) -> int:
+        """Take before reading a user's cycle data; pass to put() so results raced by a write are not cached."""
+        with self._lock:
+            return self._versions.version(username)
+
+    def get(self, username: str):
+        """Return (result, update_time) for a fresh entry, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+            result, update_time, expires_at = entry
+            if expires_at <= now:
+                del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return result, update_time
+
+    def put(self, username: str, result: dict, update_time, token: int = None):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if token is not None and token != self._versions.version(username):
+                return
+            self._entries[username] = (result, update_time, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(username)
+            self._evict()
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._versions.bump(username)
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._versions.bump_all()
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        while len(self._entries) > max(self.max_size, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+prediction_cache = PredictionCache()
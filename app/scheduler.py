@@ -1,16 +1,26 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from app.training_utils import train_with_feedback
+from datetime import datetime
+from app.firebase_service import get_training_run_state
+from app.training_utils import retrain_all_users
 import logging
 
-def start_scheduler():
+def start_scheduler(max_workers: int = 4):
+    # Imported here so APScheduler stays off the import path when the scheduler is disabled
+    from apscheduler.schedulers.background import BackgroundScheduler
     logging.info("Starting background scheduler...")
     scheduler = BackgroundScheduler()
 
     def retrain_model():
         logging.info("Retraining model job started (with feedback-aware logic).")
-        train_with_feedback()
+        retrain_all_users(max_workers=max_workers)
         logging.info("Model retraining completed.")
 
-    scheduler.add_job(retrain_model, 'interval', weeks=2)
+    scheduler.add_job(retrain_model, 'interval', weeks=2, id="retrain_all_users")
+    # Resume a run that was interrupted by a restart; users already retrained are skipped by their watermarks
+    try:
+        if get_training_run_state().get("status") == "running":
+            logging.info("Previous scheduled retraining did not finish. Resuming now.")
+            scheduler.add_job(retrain_model, 'date', run_date=datetime.now(), id="resume_retrain")
+    except Exception as e:
+        logging.warning(f"Could not read scheduled retraining state: {e}")
     scheduler.start()
     logging.info("Scheduler started and retrain job scheduled every 2 weeks.")
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from app.metrics import SINGLE_FLIGHT_COALESCED
+
+
+class _LeaderCancelled(Exception):
+    """Set on a flight whose leading request was cancelled; waiters start a new flight instead."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent loads of the same key into one in-flight call. The first caller (the leader)
+    runs the load; callers arriving while it runs wait for and share its result or exception.
+    Flights are plain concurrent.futures.Future objects, so sync callers in the threadpool and async
+    callers on the event loop join each other's flights. Sync callers must not run on the event loop
+    thread, where waiting for an async leader would block it.
+
+    Keys should include the user's cache invalidation version taken before the load (see
+    CycleStore.token), so a caller that starts after a write never shares a read that began before it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._coalesced_metric = SINGLE_FLIGHT_COALESCED.labels(name)
+        self.loads = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        """Return (future, is_leader) for the key's flight, starting one if none is in progress."""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                self._coalesced_metric.inc()
+                return future, False
+            future = Future()
+            self._flights[key] = future
+            self.loads += 1
+            return future, True
+
+    def _land(self, key, future: Future, result=None, error: BaseException = None):
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def do(self, key, fn, *args):
+        """Return fn(*args), sharing the call with concurrent do()/ado() callers of the same key."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return future.result()
+            except _LeaderCancelled:
+                continue
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._land(key, future, error=e)
+            raise
+        self._land(key, future, result)
+        return result
+
+    async def ado(self, key, fn, *args):
+        """Async do(): returns await fn(*args), shared with concurrent callers of the same key."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                # Shielded so a waiter's own cancellation does not cancel the shared flight
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _LeaderCancelled:
+                continue
+        try:
+            result = await fn(*args)
+        except asyncio.CancelledError:
+            self._land(key, future, error=_LeaderCancelled())
+            raise
+        except BaseException as e:
+            self._land(key, future, error=e)
+            raise
+        self._land(key, future, result)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "loads": self.loads, "coalesced": self.coalesced}
+
+
+# Process-wide flights for menstrual_data documents and user records
+cycle_reads = SingleFlight("cycle_data")
+user_reads = SingleFlight("users")
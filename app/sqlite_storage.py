@@ -0,0 +1,266 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+from app.storage import DATES_FIELD, MODEL_STATE_FIELD, StorageBackend, cycle_dates, legacy_keys
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS cycle_data (username TEXT PRIMARY KEY, data TEXT NOT NULL, update_time TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_id TEXT UNIQUE,
+    username TEXT,
+    created_at TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feedback_username_created ON feedback (username, created_at);
+CREATE TABLE IF NOT EXISTS training_watermarks (username TEXT PRIMARY KEY, data_update_time TEXT, trained_at TEXT);
+CREATE TABLE IF NOT EXISTS training_runs (id TEXT PRIMARY KEY, state TEXT NOT NULL);
+"""
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Local storage backend for load testing and offline benchmarks.
+    path=":memory:" keeps everything in process. A single connection guarded by a lock is
+    shared across threads; async methods run inline, which is fine for a local database.
+    Update times are strictly increasing UTC datetimes, like Firestore's.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.executescript(_SCHEMA)
+        self._last_time = datetime.min.replace(tzinfo=timezone.utc)
+
+    def _now(self) -> datetime:
+        # Called with the lock held; never hand out the same timestamp twice
+        now = datetime.now(timezone.utc)
+        if now <= self._last_time:
+            now = self._last_time + timedelta(microseconds=1)
+        self._last_time = now
+        return now
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # --- Users ---
+    def get_user(self, username):
+        rows = self._query("SELECT data FROM users WHERE username = ?", (username,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def create_user(self, username, data):
+        with self._lock:
+            try:
+                self._conn.execute("INSERT INTO users (username, data) VALUES (?, ?)", (username, json.dumps(data)))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def update_user(self, username, fields):
+        with self._lock:
+            data = self.get_user(username)
+            if data is None:
+                raise KeyError(f"User {username} not found")
+            data.update(fields)
+            self._conn.execute("UPDATE users SET data = ? WHERE username = ?", (json.dumps(data), username))
+
+    def list_usernames(self, page_size=300):
+        last = ""
+        while True:
+            rows = self._query("SELECT username FROM users WHERE username > ? ORDER BY username LIMIT ?",
+                               (last, page_size))
+            for (username,) in rows:
+                yield username
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    # --- Cycle data ---
+    def get_cycle_doc(self, username):
+        rows = self._query("SELECT data, update_time FROM cycle_data WHERE username = ?", (username,))
+        if not rows:
+            return None, None
+        return json.loads(rows[0][0]), datetime.fromisoformat(rows[0][1])
+
+    def get_cycle_update_time(self, username):
+        rows = self._query("SELECT update_time FROM cycle_data WHERE username = ?", (username,))
+        return datetime.fromisoformat(rows[0][0]) if rows else None
+
+    def get_cycle_docs(self, usernames):
+        result = {}
+        # SQLite limits bound parameters per statement
+        for start in range(0, len(usernames), 500):
+            chunk = usernames[start:start + 500]
+            rows = self._query(
+                f"SELECT username, data, update_time FROM cycle_data WHERE username IN ({','.join('?' * len(chunk))})",
+                chunk)
+            for username, data, update_time in rows:
+                result[username] = (json.loads(data), datetime.fromisoformat(update_time))
+        return result
+
+    def page_cycle_docs(self, cursor, limit):
+        rows = self._query(
+            "SELECT username, data, update_time FROM cycle_data WHERE username > ? ORDER BY username LIMIT ?",
+            (cursor or "", limit))
+        items = [(username, json.loads(data), datetime.fromisoformat(update_time))
+                 for username, data, update_time in rows]
+        return items, (items[-1][0] if len(items) == limit else None)
+
+    def _write_cycle_doc(self, username, data):
+        update_time = self._now()
+        self._conn.execute(
+            "INSERT INTO cycle_data (username, data, update_time) VALUES (?, ?, ?) "
+            "ON CONFLICT(username) DO UPDATE SET data = excluded.data, update_time = excluded.update_time",
+            (username, json.dumps(data), update_time.isoformat()))
+        return update_time
+
+    def init_cycle_doc(self, username):
+        with self._lock:
+            self._write_cycle_doc(username, {})
+
+    def append_cycle_date(self, username, date, fields_fn=None):
+        with self._lock:
+            data, _ = self.get_cycle_doc(username)
+            data = data or {}
+            fields = fields_fn(data) if fields_fn is not None else {}
+            dates = list(data.get(DATES_FIELD) or [])
+            if date not in dates:
+                dates.append(date)
+            data[DATES_FIELD] = dates
+            data.update(fields)
+            self._write_cycle_doc(username, data)
+
+    def write_cycle_fields(self, username, fields, update_time, date=None):
+        with self._lock:
+            data, current = self.get_cycle_doc(username)
+            if data is None or current != update_time:
+                return None
+            if date is not None and date not in (data.get(DATES_FIELD) or []):
+                data[DATES_FIELD] = list(data.get(DATES_FIELD) or []) + [date]
+            data.update(fields)
+            return self._write_cycle_doc(username, data)
+
+    def append_cycle_dates_batch(self, histories):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for username, new_dates in histories.items():
+                    data, _ = self.get_cycle_doc(username)
+                    data = data or {}
+                    dates = list(data.get(DATES_FIELD) or [])
+                    present = set(dates)
+                    dates.extend(d for d in new_dates if d not in present)
+                    data[DATES_FIELD] = dates
+                    data.pop(MODEL_STATE_FIELD, None)
+                    self._write_cycle_doc(username, data)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def update_cycle_doc(self, username, fn):
+        with self._lock:
+            data, _ = self.get_cycle_doc(username)
+            data = data or {}
+            fields, result = fn(data)
+            for key in legacy_keys(data):
+                del data[key]
+            data.update(fields)
+            self._write_cycle_doc(username, data)
+            return result
+
+    def update_cycle_docs(self, usernames, fn):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                results = {u: self.update_cycle_doc(u, lambda data, u=u: fn(u, data)) for u in usernames}
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return results
+
+    # --- Feedback ---
+    def add_feedback(self, data, doc_id=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO feedback (doc_id, username, created_at, data) VALUES (?, ?, ?, ?)",
+                (doc_id, data.get("username"), self._now().isoformat(), json.dumps(data)))
+
+    def add_feedback_batch(self, entries):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO feedback (username, created_at, data) VALUES (?, ?, ?)",
+                    [(data.get("username"), self._now().isoformat(), json.dumps(data)) for data in entries])
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def query_feedback(self, username=None, since=None):
+        sql, params = "SELECT data, created_at FROM feedback WHERE 1 = 1", []
+        if username is not None:
+            sql += " AND username = ?"
+            params.append(username)
+        if since is not None:
+            sql += " AND created_at > ?"
+            params.append(since.isoformat())
+        rows = self._query(sql + " ORDER BY id", params)
+        return [{**json.loads(data), "created_at": datetime.fromisoformat(created_at)} for data, created_at in rows]
+
+    def page_feedback(self, cursor, limit):
+        rows = self._query("SELECT id, data, created_at FROM feedback WHERE id > ? ORDER BY id LIMIT ?",
+                           (int(cursor or 0), limit))
+        items = [(str(row_id), {**json.loads(data), "created_at": datetime.fromisoformat(created_at)})
+                 for row_id, data, created_at in rows]
+        return items, (items[-1][0] if len(items) == limit else None)
+
+    # --- Scheduled retraining state ---
+    def get_training_watermarks(self, usernames):
+        result = {}
+        for start in range(0, len(usernames), 500):
+            chunk = usernames[start:start + 500]
+            rows = self._query(
+                f"SELECT username, data_update_time FROM training_watermarks "
+                f"WHERE username IN ({','.join('?' * len(chunk))})", chunk)
+            for username, data_update_time in rows:
+                result[username] = datetime.fromisoformat(data_update_time) if data_update_time else None
+        return result
+
+    def set_training_watermark(self, username, data_update_time):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO training_watermarks (username, data_update_time, trained_at) VALUES (?, ?, ?)",
+                (username, data_update_time.isoformat() if data_update_time else None, self._now().isoformat()))
+
+    def get_training_run_state(self):
+        rows = self._query("SELECT state FROM training_runs WHERE id = 'scheduled'")
+        return json.loads(rows[0][0]) if rows else {}
+
+    def set_training_run_state(self, state):
+        with self._lock:
+            merged = {**self.get_training_run_state(), **state}
+            self._conn.execute("INSERT OR REPLACE INTO training_runs (id, state) VALUES ('scheduled', ?)",
+                               (json.dumps(merged),))
+
+    # --- Helpers for load tests ---
+    def seed_cycle_dates(self, histories: dict) -> None:
+        """Bulk-load {username: [ISO dates]} in one transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for username, dates in histories.items():
+                    self._write_cycle_doc(username, {DATES_FIELD: cycle_dates({DATES_FIELD: dates})})
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
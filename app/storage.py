@@ -0,0 +1,253 @@
+import inspect
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.config import load_flags_json
+from app.metrics import observe_storage
+
+# Collection / table names shared by every backend
+USERS = "cycle-sense-users"
+CYCLE_DATA = "menstrual_data"
+FEEDBACK = "prediction_feedback"
+TRAINING_WATERMARKS = "training_watermarks"
+TRAINING_RUNS = "training_runs"
+
+# menstrual_data/{username} keeps its history in a "dates" array that is appended to atomically.
+# Older documents store one date per serial-number field ("1", "2", ...); those are read as well
+# until app/migrate_cycle_dates.py has rewritten them.
+DATES_FIELD = "dates"
+# The user's online model state (app.model.CycleModelState.to_dict()), kept in the same document
+MODEL_STATE_FIELD = "model_state"
+
+
+def cycle_dates(data: dict) -> List[str]:
+    # Legacy fields that are serial numbers (1, 2, 3, ...) come first, then the dates array
+    serial_dates = [(int(k), v) for k, v in data.items() if k.isdigit()]
+    serial_dates.sort()
+    dates = [v for _, v in serial_dates] + list(data.get(DATES_FIELD) or [])
+    return list(dict.fromkeys(dates))
+
+
+def legacy_keys(data: dict) -> List[str]:
+    return [k for k in data if k.isdigit()]
+
+
+class StorageBackend:
+    """
+    Repository interface for users, cycle data, feedback and training state.
+    Cycle documents are returned as (data, update_time) where data has the Firestore
+    document shape ({"dates": [...], "model_state": {...}} plus any legacy serial-number fields) and is None
+    when the user has no document. Async methods default to calling the sync ones,
+    which suits local backends; FirestoreStorage overrides them with AsyncClient calls.
+    """
+
+    name = "base"
+
+    # --- Users ---
+    def get_user(self, username: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def create_user(self, username: str, data: dict) -> bool:
+        """Create the user document; returns False if it already exists."""
+        raise NotImplementedError
+
+    def update_user(self, username: str, fields: dict) -> None:
+        raise NotImplementedError
+
+    def list_usernames(self, page_size: int = 300) -> Iterator[str]:
+        raise NotImplementedError
+
+    # --- Cycle data ---
+    def get_cycle_doc(self, username: str) -> Tuple[Optional[dict], object]:
+        raise NotImplementedError
+
+    def get_cycle_update_time(self, username: str):
+        """Update time of the user's cycle document (None if missing), read without its fields."""
+        raise NotImplementedError
+
+    def get_cycle_docs(self, usernames: List[str]) -> Dict[str, Tuple[dict, object]]:
+        """Bulk read; only users with a document appear in the result."""
+        raise NotImplementedError
+
+    def init_cycle_doc(self, username: str) -> None:
+        """Create (or reset) an empty cycle document for a new user."""
+        raise NotImplementedError
+
+    def append_cycle_date(self, username: str, date: str, fields_fn=None) -> None:
+        """
+        Atomically add a date to the user's dates array (no-op if present), creating the document if missing.
+        With fields_fn, the current document ({} if missing) is read in the same atomic step and the
+        fields returned by fields_fn(data) are written together with the date.
+        """
+        raise NotImplementedError
+
+    def write_cycle_fields(self, username: str, fields: dict, update_time, date: Optional[str] = None):
+        """
+        Write fields (and add date to the dates array, when given) in a single write that only
+        applies while the document's update time is still update_time. Returns the new update time,
+        or None when the document changed or does not exist; nothing is written then.
+        """
+        raise NotImplementedError
+
+    def append_cycle_dates_batch(self, histories: Dict[str, List[str]]) -> None:
+        """
+        Add {username: [dates]} to many users' dates arrays with batched writes and no reads, creating
+        missing documents. Their model_state is dropped so it is rebuilt from the merged dates.
+        """
+        raise NotImplementedError
+
+    def update_cycle_doc(self, username: str, fn):
+        """
+        Atomic read-modify-write: fn(data) returns (fields, result) where data is the current
+        document ({} if missing). fields (e.g. {"dates": [...]}) are written, legacy serial-number
+        fields are dropped, and result is returned.
+        """
+        raise NotImplementedError
+
+    def update_cycle_docs(self, usernames: List[str], fn) -> Dict[str, object]:
+        """
+        update_cycle_doc for many users with batched reads and writes: fn(username, data) returns
+        (fields, result). Each document is still updated atomically; returns {username: result}.
+        """
+        raise NotImplementedError
+
+    def page_cycle_docs(self, cursor: Optional[str], limit: int) -> Tuple[List[Tuple[str, dict, object]], Optional[str]]:
+        """
+        One page of cycle documents in username order, after `cursor` (a username, None for the start).
+        Returns ([(username, data, update_time)], next_cursor); next_cursor is None after the last page.
+        """
+        raise NotImplementedError
+
+    # --- Feedback ---
+    def add_feedback(self, data: dict, doc_id: Optional[str] = None) -> None:
+        """Store a feedback entry, stamping a created_at timestamp."""
+        raise NotImplementedError
+
+    def add_feedback_batch(self, entries: List[dict]) -> None:
+        """Store many feedback entries with batched writes."""
+        raise NotImplementedError
+
+    def query_feedback(self, username: Optional[str] = None, since=None) -> List[dict]:
+        raise NotImplementedError
+
+    def page_feedback(self, cursor: Optional[str], limit: int) -> Tuple[List[Tuple[str, dict]], Optional[str]]:
+        """One page of feedback entries in storage order: ([(entry_id, data)], next_cursor), like page_cycle_docs."""
+        raise NotImplementedError
+
+    # --- Scheduled retraining state ---
+    def get_training_watermarks(self, usernames: List[str]) -> Dict[str, object]:
+        raise NotImplementedError
+
+    def set_training_watermark(self, username: str, data_update_time) -> None:
+        raise NotImplementedError
+
+    def get_training_run_state(self) -> dict:
+        raise NotImplementedError
+
+    def set_training_run_state(self, state: dict) -> None:
+        raise NotImplementedError
+
+    # --- Async variants ---
+    async def aget_user(self, username):
+        return self.get_user(username)
+
+    async def acreate_user(self, username, data):
+        return self.create_user(username, data)
+
+    async def aupdate_user(self, username, fields):
+        return self.update_user(username, fields)
+
+    async def aget_cycle_doc(self, username):
+        return self.get_cycle_doc(username)
+
+    async def aget_cycle_update_time(self, username):
+        return self.get_cycle_update_time(username)
+
+    async def aget_cycle_docs(self, usernames):
+        return self.get_cycle_docs(usernames)
+
+    async def ainit_cycle_doc(self, username):
+        return self.init_cycle_doc(username)
+
+    async def aappend_cycle_date(self, username, date, fields_fn=None):
+        return self.append_cycle_date(username, date, fields_fn)
+
+    async def awrite_cycle_fields(self, username, fields, update_time, date=None):
+        return self.write_cycle_fields(username, fields, update_time, date)
+
+    async def aappend_cycle_dates_batch(self, histories):
+        return self.append_cycle_dates_batch(histories)
+
+    async def aupdate_cycle_doc(self, username, fn):
+        return self.update_cycle_doc(username, fn)
+
+    async def aupdate_cycle_docs(self, usernames, fn):
+        return self.update_cycle_docs(usernames, fn)
+
+    async def aadd_feedback(self, data, doc_id=None):
+        return self.add_feedback(data, doc_id)
+
+    async def aadd_feedback_batch(self, entries):
+        return self.add_feedback_batch(entries)
+
+    async def aquery_feedback(self, username=None, since=None):
+        return self.query_feedback(username, since)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def _create_storage() -> StorageBackend:
+    # Backend selection, e.g. { "backend": "sqlite", "sqlite_path": ":memory:" }; defaults to Firestore
+    flags = load_flags_json("STORAGE_FLAGS_JSON")
+    backend = flags.get("backend", "firestore")
+    if backend == "sqlite":
+        from app.sqlite_storage import SQLiteStorage
+        return SQLiteStorage(flags.get("sqlite_path", ":memory:"))
+    if backend != "firestore":
+        logging.warning(f"Unknown storage backend {backend!r}. Using Firestore.")
+    from app.firestore_storage import FirestoreStorage
+    return FirestoreStorage()
+
+
+def _instrument(storage: StorageBackend) -> StorageBackend:
+    """
+    Record every backend operation in the storage_operation_* metrics, labelled with the method
+    name; async variants share their sync method's label. Cache hits never reach the backend, so
+    the metrics count actual storage calls. Generator methods (list_usernames) are left as is.
+    """
+    for name, method in vars(StorageBackend).items():
+        if name.startswith("_") or not inspect.isfunction(method):
+            continue
+        implementation = getattr(type(storage), name)
+        if inspect.isgeneratorfunction(implementation):
+            continue
+        if inspect.iscoroutinefunction(method):
+            if implementation is method:
+                # The default async variant calls the instrumented sync method
+                continue
+            operation = name[1:]
+        else:
+            operation = name
+        setattr(storage, name, observe_storage(operation)(getattr(storage, name)))
+    return storage
+
+
+def get_storage() -> StorageBackend:
+    """The process-wide storage backend, chosen from STORAGE_FLAGS_JSON on first use."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = _instrument(_create_storage())
+                logging.info(f"Using {_storage.name} storage backend.")
+    return _storage
+
+
+def set_storage(storage: Optional[StorageBackend]) -> None:
+    """Replace the process-wide backend (benchmarks, load tests); None re-reads the env config."""
+    global _storage
+    with _storage_lock:
+        _storage = _instrument(storage) if storage is not None else None
@@ -0,0 +1,142 @@
+import logging
+import queue
+import threading
+import time
+from cachetools import TTLCache
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_DEBOUNCE_SECONDS = 300
+# Upper bound on usernames remembered for debouncing
+DEBOUNCE_MAX_USERS = 100000
+
+
+class TrainingQueue:
+    """
+    Bounded background training queue with a fixed worker pool.
+    Pending jobs for the same username are coalesced, users trained within
+    debounce_seconds are skipped, and a full queue drops new jobs instead of
+    spawning more threads.
+    """
+
+    def __init__(self, train_fn, workers: int = DEFAULT_WORKERS, max_pending: int = DEFAULT_MAX_PENDING,
+                 debounce_seconds: float = DEFAULT_DEBOUNCE_SECONDS):
+        self._train_fn = train_fn
+        self._workers = max(int(workers), 1)
+        self._queue = queue.Queue(maxsize=max(int(max_pending), 1))
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._recently_trained = TTLCache(maxsize=DEBOUNCE_MAX_USERS, ttl=debounce_seconds) if debounce_seconds > 0 else None
+        self._threads = []
+        self._started = False
+        self._accepting = True
+        self._metrics = {
+            "submitted": 0,
+            "coalesced": 0,
+            "debounced": 0,
+            "dropped": 0,
+            "completed": 0,
+            "failed": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "run_seconds_total": 0.0,
+            "run_seconds_max": 0.0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._started = True
+            self._accepting = True
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._worker, name=f"training-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logging.info(f"Training queue started with {self._workers} workers.")
+
+    def submit(self, username: str) -> str:
+        """Enqueue a training job. Returns 'queued', 'coalesced', 'debounced', 'dropped' or 'closed'."""
+        if not self._started:
+            self.start()
+        with self._lock:
+            if not self._accepting:
+                return "closed"
+            if username in self._pending:
+                self._metrics["coalesced"] += 1
+                return "coalesced"
+            if self._recently_trained is not None and username in self._recently_trained:
+                self._metrics["debounced"] += 1
+                return "debounced"
+            try:
+                self._queue.put_nowait((username, time.monotonic()))
+            except queue.Full:
+                self._metrics["dropped"] += 1
+                logging.warning(f"Training queue full; dropping training job for {username}.")
+                return "dropped"
+            self._pending.add(username)
+            self._metrics["submitted"] += 1
+            return "queued"
+
+    def shutdown(self, drain: bool = True, timeout: float = 30.0):
+        """Stop accepting jobs; with drain=True finish queued jobs first (bounded by timeout)."""
+        with self._lock:
+            self._accepting = False
+            threads = self._threads
+            self._threads = []
+        if not drain:
+            try:
+                while True:
+                    username, _ = self._queue.get_nowait()
+                    with self._lock:
+                        self._pending.discard(username)
+                    self._queue.task_done()
+            except queue.Empty:
+                pass
+        deadline = time.monotonic() + timeout
+        for _ in threads:
+            try:
+                self._queue.put(None, timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(timeout=max(deadline - time.monotonic(), 0))
+        logging.info(f"Training queue stopped (remaining jobs: {self._queue.qsize()}).")
+
+    def stats(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            finished = metrics["completed"] + metrics["failed"]
+            metrics["depth"] = self._queue.qsize()
+            metrics["pending"] = len(self._pending)
+            metrics["workers"] = len(self._threads)
+        metrics["wait_seconds_avg"] = metrics["wait_seconds_total"] / finished if finished else 0.0
+        metrics["run_seconds_avg"] = metrics["run_seconds_total"] / finished if finished else 0.0
+        return metrics
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            username, enqueued_at = job
+            started = time.monotonic()
+            ok = False
+            try:
+                self._train_fn(username)
+                ok = True
+            except Exception as e:
+                logging.error(f"Background training failed for {username}: {e}")
+            finished = time.monotonic()
+            with self._lock:
+                self._pending.discard(username)
+                if ok and self._recently_trained is not None:
+                    self._recently_trained[username] = finished
+                self._metrics["completed" if ok else "failed"] += 1
+                wait, run = started - enqueued_at, finished - started
+                self._metrics["wait_seconds_total"] += wait
+                self._metrics["wait_seconds_max"] = max(self._metrics["wait_seconds_max"], wait)
+                self._metrics["run_seconds_total"] += run
+                self._metrics["run_seconds_max"] = max(self._metrics["run_seconds_max"], run)
+            self._queue.task_done()
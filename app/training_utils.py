@@ -1,26 +1,106 @@
 import logging
-from app.firebase_service import fetch_cycle_data, fetch_feedback
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from app.firebase_service import (
+    fetch_cycle_history,
+    fetch_cycle_snapshots_batch,
+    fetch_feedback,
+    fetch_training_watermarks,
+    list_usernames,
+    set_training_run_state,
+    store_model_state,
+    store_training_watermark,
+)
+from app.metrics import RETRAIN_RUN_DURATION, observe_training
 from app.model import train_model
 
+# Users scanned per page during scheduled retraining
+RETRAIN_PAGE_SIZE = 300
 
-def train_with_feedback(collection_name: str = "menstrual_data"):
+
+def _train_history(collection_name: str, history):
+    """
+    Train on the user's stored dates plus their feedback dates. A model state that was missing or
+    stale in the document (e.g. after a bulk import) is written back, so reads stop rebuilding it;
+    it is the state of the stored dates, which is what reads check it against (feedback dates are
+    merged into them when feedback is stored). Returns (trained, data_update_time), the update
+    time being the document's after that write.
+    """
     logging.info(
         f"Training model with feedback-aware logic for collection: {collection_name}")
-    dates = fetch_cycle_data(collection_name)
-    feedback_collection = collection_name.replace(
-        "menstrual_data", "prediction_feedback")
-    feedback = fetch_feedback(feedback_collection)
-    all_dates = dates[:]
-    for fb in feedback:
-        if "actual_date" in fb and fb["actual_date"] not in all_dates:
-            all_dates.append(fb["actual_date"])
-    all_dates = sorted(all_dates)
+    # Only this user's feedback documents are read
+    feedback = fetch_feedback(username=collection_name)
+    all_dates = sorted(set(history.iso_dates()).union(
+        fb["actual_date"] for fb in feedback if fb.get("actual_date")))
     model = train_model(all_dates)
+    update_time = history.update_time
+    # An empty history's state is free to rebuild; skipping it saves a write on a new user's first login
+    if not history.state_stored and len(history) and update_time is not None:
+        update_time = store_model_state(collection_name, history) or update_time
     if model is not None:
         logging.info(
             f"Model trained successfully with feedback for {collection_name}")
-        return True
     else:
         logging.warning(
             f"Not enough data to train the model for {collection_name}")
-        return False
+    return model is not None, update_time
+
+
+def train_with_feedback(collection_name: str = "menstrual_data") -> bool:
+    return _train_history(collection_name, fetch_cycle_history(collection_name))[0]
+
+
+# Scheduled per-user jobs are recorded apart from queued and manual training
+_train_scheduled = observe_training("scheduler", _train_history)
+
+
+def _retrain_user(username, history):
+    _, update_time = _train_scheduled(username, history)
+    # The update time after any model state write, so the user is not retrained for it next run
+    store_training_watermark(username, update_time)
+
+
+def retrain_all_users(max_workers: int = 4, page_size: int = RETRAIN_PAGE_SIZE) -> dict:
+    """
+    Retrain every user whose menstrual_data changed since their stored watermark.
+    Feedback that carries an actual_date is always written into menstrual_data as well,
+    so the document's update time covers both sources. Users are processed a page at a time
+    with a bounded thread pool; watermarks are written per user, so a run interrupted by a
+    restart resumes by skipping everyone already retrained.
+    """
+    started = time.monotonic()
+    set_training_run_state({"status": "running", "started_at": time.time()})
+    stats = {"scanned": 0, "skipped": 0, "retrained": 0, "failed": 0}
+    usernames = list_usernames(page_size=page_size)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrain") as pool:
+        while True:
+            page = list(islice(usernames, page_size))
+            if not page:
+                break
+            stats["scanned"] += len(page)
+            snapshots = fetch_cycle_snapshots_batch(page)
+            watermarks = fetch_training_watermarks(page)
+            changed = [
+                (u, history) for u, history in snapshots.items()
+                if history.update_time is not None and watermarks.get(u) != history.update_time
+            ]
+            stats["skipped"] += len(page) - len(changed)
+            futures = {pool.submit(_retrain_user, *job): job[0] for job in changed}
+            for future, username in futures.items():
+                try:
+                    future.result()
+                    stats["retrained"] += 1
+                except Exception as e:
+                    stats["failed"] += 1
+                    logging.error(f"Scheduled retraining failed for {username}: {e}")
+    elapsed = time.monotonic() - started
+    RETRAIN_RUN_DURATION.observe(elapsed)
+    stats["seconds"] = round(elapsed, 3)
+    stats["users_per_sec"] = round(stats["scanned"] / elapsed, 1) if elapsed > 0 else None
+    set_training_run_state({"status": "completed", "finished_at": time.time(), "last_run": stats})
+    logging.info(
+        f"Scheduled retraining finished: scanned={stats['scanned']} retrained={stats['retrained']} "
+        f"skipped={stats['skipped']} failed={stats['failed']} in {stats['seconds']}s "
+        f"({stats['users_per_sec']} users/sec)")
+    return stats
@@ -1,10 +1,53 @@
 import hashlib
 import logging
-from firebase_admin import firestore
+import threading
+from cachetools import TTLCache
 from typing import Optional, Dict
-import sys
+from app.auth import sessions
+from app.invalidation import InvalidationVersions
+from app.single_flight import user_reads
+from app.storage import get_storage
 
-db = firestore.client()
+# Bounded, TTL-expiring cache of verified credential hashes (username -> hash)
+# so repeated logins are answered without a storage read.
+CREDENTIAL_CACHE_MAXSIZE = 10000
+CREDENTIAL_CACHE_TTL_SECONDS = 300
+_credential_cache = TTLCache(maxsize=CREDENTIAL_CACHE_MAXSIZE, ttl=CREDENTIAL_CACHE_TTL_SECONDS)
+_credential_cache_lock = threading.Lock()
+# Per-user versions bumped whenever a user record changes, so user reads coalesce only with reads
+# started since; other users' writes do not split their flights
+_user_versions = InvalidationVersions(max_tracked=CREDENTIAL_CACHE_MAXSIZE)
+
+
+def _get_cached_credential(username: str) -> Optional[str]:
+    with _credential_cache_lock:
+        return _credential_cache.get(username)
+
+
+def _cache_credential(username: str, hashed_password: str) -> None:
+    with _credential_cache_lock:
+        _credential_cache[username] = hashed_password
+
+
+def invalidate_credential(username: str) -> None:
+    """Drop any cached credential hash for a user."""
+    with _credential_cache_lock:
+        _credential_cache.pop(username, None)
+        _user_versions.bump(username)
+
+
+def _user_version(username: str) -> int:
+    with _credential_cache_lock:
+        return _user_versions.version(username)
+
+
+def _read_user(username: str):
+    """Read a user record; concurrent reads of the same user share one storage call."""
+    return user_reads.do((username, _user_version(username)), get_storage().get_user, username)
+
+
+async def _aread_user(username: str):
+    return await user_reads.ado((username, _user_version(username)), get_storage().aget_user, username)
 
 
 def hash_password(password: str) -> str:
@@ -12,79 +55,93 @@ def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
 
-def create_user(username: str, password: str) -> Dict:
+def _new_user_data(username: str, password: str, security_question: Optional[str], security_answer: Optional[str]) -> Dict:
+    # Hash the password
+    hashed_password = hash_password(password)
+    return {
+        "username": username,
+        "password": hashed_password,
+        "securityQuestion": security_question,
+        "securityAnswer": security_answer,
+    }
+
+
+def _failed(action: str, e: Exception) -> Dict:
+    logging.error(f"Error {action}: {str(e)}")
+    return {"success": False, "error": str(e)}
+
+
+def _security_question_result(user_data) -> Dict:
+    if user_data is None:
+        return {"success": False, "error": "User not found"}
+    return {"success": True, "securityQuestion": user_data.get("securityQuestion")}
+
+
+def _security_answer_error(user_data, security_answer: str) -> Optional[Dict]:
+    """Failure result when the user is missing or the answer is wrong; None if the reset may proceed."""
+    if user_data is None:
+        return {"success": False, "error": "User not found"}
+    if user_data.get("securityAnswer") != security_answer.lower():
+        return {"success": False, "error": "Incorrect security answer"}
+    return None
+
+
+def _password_reset(username: str) -> Dict:
+    invalidate_credential(username)
+    # Sessions issued with the old password stop verifying
+    sessions.revoke(username)
+    return {"success": True, "message": "Password reset successfully"}
+
+
+def _login_result(username: str, user_data, hashed_password: str) -> Dict:
+    if user_data is not None and user_data.get("password") == hashed_password:
+        _cache_credential(username, hashed_password)
+        return {"success": True}
+    return {"success": False, "error": "Invalid credentials"}
+
+
+def create_user(username: str, password: str, security_question: Optional[str] = None,
+                security_answer: Optional[str] = None) -> Dict:
     """
     Create a new user in the cycle-sense-users collection
     Returns: Dict with success status and message/error
     """
     try:
-        # Check if username already exists
-        users_ref = db.collection("cycle-sense-users")
-        if any(doc.to_dict()["username"] == username for doc in users_ref.stream()):
-            return {"success": False, "error": "Username already exists"}
-
-        # Hash the password
-        hashed_password = hash_password(password)
+        user_data = _new_user_data(username, password, security_question, security_answer)
 
-        # Accept security question and answer from global context (set by FastAPI endpoint)
-        # Use global context for security question/answer if available
-        security_question = None
-        security_answer = None
-        # Try both app.main and __main__ for context
-        main_mod = sys.modules.get('app.main')
-        if not main_mod:
-            main_mod = sys.modules.get('__main__')
-        if main_mod and hasattr(main_mod, '_SECURITY_CONTEXT') and main_mod._SECURITY_CONTEXT:
-            security_question = main_mod._SECURITY_CONTEXT.get('security_question')
-            security_answer = main_mod._SECURITY_CONTEXT.get('security_answer')
-        user_data = {
-            "username": username,
-            "password": hashed_password,
-            "securityQuestion": security_question,
-            "securityAnswer": security_answer,
-        }
-
-        users_ref.document(username).set(user_data)
+        # Users are keyed by username; the create fails if the user already exists,
+        # so the duplicate check and the write are a single round trip.
+        storage = get_storage()
+        if not storage.create_user(username, user_data):
+            return {"success": False, "error": "Username already exists"}
 
         # Initialize user's menstrual data document in 'menstrual_data' collection
-        db.collection("menstrual_data").document(username).set({})
+        storage.init_cycle_doc(username)
 
         return {"success": True, "message": "User created successfully"}
     except Exception as e:
-        logging.error(f"Error creating user: {str(e)}")
-        return {"success": False, "error": str(e)}
+        return _failed("creating user", e)
 
 
 def get_security_question(username: str) -> Dict:
     """Get the security question for a given username."""
     try:
-        user_doc = db.collection("cycle-sense-users").document(username).get()
-        if not user_doc.exists:
-            return {"success": False, "error": "User not found"}
-        user_data = user_doc.to_dict() or {}
-        return {"success": True, "securityQuestion": user_data.get("securityQuestion")}
+        return _security_question_result(_read_user(username))
     except Exception as e:
-        logging.error(f"Error getting security question: {str(e)}")
-        return {"success": False, "error": str(e)}
+        return _failed("getting security question", e)
 
 
 def verify_security_answer_and_reset(username: str, security_answer: str, new_password: str) -> Dict:
     """Verify the security answer and reset the password if correct."""
     try:
-        user_ref = db.collection("cycle-sense-users").document(username)
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-            return {"success": False, "error": "User not found"}
-        user_data = user_doc.to_dict() or {}
-        if user_data.get("securityAnswer") != security_answer.lower():
-            return {"success": False, "error": "Incorrect security answer"}
-        # Reset password
-        hashed_password = hash_password(new_password)
-        user_ref.update({"password": hashed_password})
-        return {"success": True, "message": "Password reset successfully"}
+        storage = get_storage()
+        error = _security_answer_error(storage.get_user(username), security_answer)
+        if error is not None:
+            return error
+        storage.update_user(username, {"password": hash_password(new_password)})
+        return _password_reset(username)
     except Exception as e:
-        logging.error(f"Error resetting password: {str(e)}")
-        return {"success": False, "error": str(e)}
+        return _failed("resetting password", e)
 
 
 def validate_login(username: str, password: str) -> Dict:
@@ -93,22 +150,56 @@ def validate_login(username: str, password: str) -> Dict:
     Returns: Dict with validation result and user's collection name if successful
     """
     try:
-        users_ref = db.collection("cycle-sense-users")
-        users = users_ref.stream()
-
         hashed_password = hash_password(password)
+        if _get_cached_credential(username) == hashed_password:
+            return {"success": True}
+        return _login_result(username, _read_user(username), hashed_password)
+    except Exception as e:
+        return _failed("validating login", e)
 
-        for user_doc in users:
-            user_data = user_doc.to_dict()
-            if user_data["username"] == username and user_data["password"] == hashed_password:
-                return {
-                    "success": True
-                }
 
-        return {"success": False, "error": "Invalid credentials"}
+# --- Async variants used by the FastAPI endpoints ---
+
+async def create_user_async(username: str, password: str, security_question: Optional[str] = None,
+                            security_answer: Optional[str] = None) -> Dict:
+    try:
+        user_data = _new_user_data(username, password, security_question, security_answer)
+        storage = get_storage()
+        if not await storage.acreate_user(username, user_data):
+            return {"success": False, "error": "Username already exists"}
+        await storage.ainit_cycle_doc(username)
+        return {"success": True, "message": "User created successfully"}
+    except Exception as e:
+        return _failed("creating user", e)
+
+
+async def get_security_question_async(username: str) -> Dict:
+    try:
+        return _security_question_result(await _aread_user(username))
+    except Exception as e:
+        return _failed("getting security question", e)
+
+
+async def verify_security_answer_and_reset_async(username: str, security_answer: str, new_password: str) -> Dict:
+    try:
+        storage = get_storage()
+        error = _security_answer_error(await storage.aget_user(username), security_answer)
+        if error is not None:
+            return error
+        await storage.aupdate_user(username, {"password": hash_password(new_password)})
+        return _password_reset(username)
+    except Exception as e:
+        return _failed("resetting password", e)
+
+
+async def validate_login_async(username: str, password: str) -> Dict:
+    try:
+        hashed_password = hash_password(password)
+        if _get_cached_credential(username) == hashed_password:
+            return {"success": True}
+        return _login_result(username, await _aread_user(username), hashed_password)
     except Exception as e:
-        logging.error(f"Error validating login: {str(e)}")
-        return {"success": False, "error": str(e)}
+        return _failed("validating login", e)
 
 
 def get_user_collection(username: str) -> Optional[str]:
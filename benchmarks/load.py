@@ -0,0 +1,251 @@
+"""
+Endpoint load test: drives /login, /predict/{username}, /cycle_data/{username},
+/add-cycle-date/{username}, /feedback/{username} and /train/{username} with concurrent
+clients and prints requests/sec and p50/p95/p99 latency per endpoint as JSON, followed by
+predict_next_dates / predict_from_state microbenchmarks at several history lengths.
+
+By default the app runs in-process (httpx ASGITransport) on the SQLite storage backend,
+seeded with synthetic users, so no credentials or network are needed. --base-url targets a
+running server instead (e.g. uvicorn started with STORAGE_FLAGS_JSON='{"backend": "sqlite"}');
+users are then seeded through /register and /add-cycle-date.
+
+Usage:
+    python benchmarks/load.py [--users 1000] [--history 24] [--requests 2000] [--concurrency 50]
+                              [--endpoints predict,cycle_data] [--mixed] [--output report.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+import timeit
+from datetime import date, timedelta
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+PASSWORD = "load-test-password"
+ENDPOINTS = ["login", "predict", "cycle_data", "add_cycle_date", "feedback", "train"]
+MICRO_HISTORY_LENGTHS = [3, 12, 48, 240, 1000]
+
+
+def _synthetic_dates(rng: random.Random, length: int):
+    day = date(2015, 1, 1) + timedelta(days=rng.randrange(365))
+    dates = []
+    for _ in range(length):
+        dates.append(day.isoformat())
+        day += timedelta(days=rng.randint(24, 35))
+    return dates
+
+
+def _synthetic_histories(users: int, length: int, seed: int = 0):
+    rng = random.Random(seed)
+    return {f"loaduser{i:06d}": _synthetic_dates(rng, length) for i in range(users)}
+
+
+class Scenario:
+    """Builds one request per call for an endpoint; add-cycle-date and feedback send fresh dates."""
+
+    def __init__(self, tokens, seed: int = 0):
+        self.tokens = tokens
+        self.usernames = list(tokens)
+        self.rng = random.Random(seed)
+        self.next_day = date(2030, 1, 1)
+
+    def _user(self):
+        return self.rng.choice(self.usernames)
+
+    def _new_date(self):
+        self.next_day += timedelta(days=1)
+        return self.next_day.isoformat()
+
+    def request(self, endpoint: str):
+        """(method, path, json body, headers) for one request; per-user endpoints carry the user's token."""
+        username = self._user()
+        auth = {"Authorization": f"Bearer {self.tokens[username]}"}
+        if endpoint == "login":
+            return "POST", "/login", {"username": username, "password": PASSWORD}, None
+        if endpoint == "predict":
+            return "GET", f"/predict/{username}", None, auth
+        if endpoint == "cycle_data":
+            return "GET", f"/cycle_data/{username}", None, auth
+        if endpoint == "add_cycle_date":
+            return "POST", f"/add-cycle-date/{username}", {"date": self._new_date()}, auth
+        if endpoint == "feedback":
+            actual = self._new_date()
+            return "POST", f"/feedback/{username}", {"predicted_date": actual, "actual_date": actual}, auth
+        if endpoint == "train":
+            return "POST", f"/train/{username}", None, auth
+        raise ValueError(f"Unknown endpoint {endpoint!r}")
+
+
+def _summary(latencies, errors: int, elapsed: float) -> dict:
+    ms = np.asarray(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99]) if len(ms) else (0.0, 0.0, 0.0)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(ms.max()), 3) if len(ms) else 0.0,
+    }
+
+
+async def _drive(client, scenario: Scenario, plan, concurrency: int):
+    """Send the planned requests from `concurrency` workers; returns per-endpoint results and wall time."""
+    latencies = {endpoint: [] for endpoint in set(plan)}
+    errors = {endpoint: 0 for endpoint in set(plan)}
+    requests = iter(plan)
+
+    async def worker():
+        for endpoint in requests:
+            method, path, body, headers = scenario.request(endpoint)
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body, headers=headers)
+            latencies[endpoint].append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[endpoint] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def run_load(client, tokens, endpoints, requests: int, concurrency: int, mixed: bool) -> dict:
+    scenario = Scenario(tokens)
+    report = {}
+    # Warm-up: one pass per endpoint so lazy imports and first-use setup are not measured
+    await _drive(client, scenario, endpoints, 1)
+    if mixed:
+        plan = [endpoints[i % len(endpoints)] for i in range(requests)]
+        latencies, errors, elapsed = await _drive(client, scenario, plan, concurrency)
+        report["mixed"] = {"seconds": round(elapsed, 3), "rps": round(len(plan) / elapsed, 1)}
+        for endpoint in endpoints:
+            report[endpoint] = _summary(latencies[endpoint], errors[endpoint], elapsed)
+        return report
+    for endpoint in endpoints:
+        latencies, errors, elapsed = await _drive(client, scenario, [endpoint] * requests, concurrency)
+        report[endpoint] = _summary(latencies[endpoint], errors[endpoint], elapsed)
+    return report
+
+
+def run_microbenchmarks(lengths=MICRO_HISTORY_LENGTHS, number: int = 2000) -> dict:
+    from app.cycle_store import CycleHistory
+    from app.model import CycleModelState, predict_from_state, predict_next_dates
+
+    rng = random.Random(1)
+    results = {}
+    for length in lengths:
+        dates = _synthetic_dates(rng, length)
+        history = CycleHistory.from_dates(dates)
+        state = CycleModelState.from_days(history.days)
+        results[str(length)] = {
+            "model_state_us": round(timeit.timeit(lambda: predict_from_state(state), number=number) / number * 1e6, 2),
+            "history_us": round(timeit.timeit(lambda: predict_next_dates(history), number=number) / number * 1e6, 2),
+            "iso_dates_us": round(timeit.timeit(lambda: predict_next_dates(dates), number=number) / number * 1e6, 2),
+        }
+    return results
+
+
+def _seed_local(histories) -> dict:
+    """Seed the SQLite backend; returns {username: session token}, issued in-process."""
+    from app.auth import sessions
+    from app.sqlite_storage import SQLiteStorage
+    from app.storage import set_storage
+    from app.user_service import _new_user_data
+
+    storage = SQLiteStorage()
+    for username in histories:
+        storage.create_user(username, _new_user_data(username, PASSWORD, "q", "a"))
+    storage.seed_cycle_dates(histories)
+    set_storage(storage)
+    return {username: sessions.issue(username)["access_token"] for username in histories}
+
+
+async def _seed_remote(client, histories, concurrency: int) -> dict:
+    """Register and log in every user, then add their dates; returns {username: session token}."""
+    semaphore = asyncio.Semaphore(concurrency)
+    tokens = {}
+
+    async def seed(username, dates):
+        async with semaphore:
+            await client.post("/register", json={"username": username, "password": PASSWORD,
+                                                 "securityQuestion": "q", "securityAnswer": "a"})
+            login = await client.post("/login", json={"username": username, "password": PASSWORD})
+            tokens[username] = login.json()["access_token"]
+            headers = {"Authorization": f"Bearer {tokens[username]}"}
+            for value in dates:
+                await client.post(f"/add-cycle-date/{username}", json={"date": value}, headers=headers)
+
+    await asyncio.gather(*(seed(u, d) for u, d in histories.items()))
+    return tokens
+
+
+async def main_async(args) -> dict:
+    import httpx
+
+    endpoints = args.endpoints.split(",")
+    histories = _synthetic_histories(args.users, args.history)
+    seed_start = time.perf_counter()
+    if args.base_url:
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=60) as client:
+            tokens = await _seed_remote(client, histories, args.concurrency)
+            seed_seconds = time.perf_counter() - seed_start
+            load = await run_load(client, tokens, endpoints, args.requests, args.concurrency, args.mixed)
+    else:
+        os.environ.setdefault("SCHEDULER_FLAGS_JSON", json.dumps({"enable_scheduler": False}))
+        os.environ.setdefault("STORAGE_FLAGS_JSON", json.dumps({"backend": "sqlite"}))
+        import app.main
+        logging.getLogger().setLevel(args.log_level)
+        tokens = _seed_local(histories)
+        seed_seconds = time.perf_counter() - seed_start
+        transport = httpx.ASGITransport(app=app.main.app)
+        # ASGITransport does not send lifespan events; run the app's lifespan around the load
+        async with app.main.app.router.lifespan_context(app.main.app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=60) as client:
+                load = await run_load(client, tokens, endpoints, args.requests, args.concurrency, args.mixed)
+    return {
+        "target": args.base_url or "in-process",
+        "users": args.users,
+        "history_length": args.history,
+        "concurrency": args.concurrency,
+        "requests_per_endpoint": None if args.mixed else args.requests,
+        "seed_seconds": round(seed_seconds, 3),
+        "endpoints": load,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=24, help="Cycle dates per synthetic user.")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="Requests per endpoint (total requests with --mixed).")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--mixed", action="store_true", help="Interleave all endpoints in one run.")
+    parser.add_argument("--base-url", help="Load-test a running server instead of the in-process app.")
+    parser.add_argument("--skip-micro", action="store_true", help="Skip the predict_next_dates microbenchmarks.")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    args = parser.parse_args()
+
+    report = {"python": sys.version.split()[0], "load": asyncio.run(main_async(args))}
+    if not args.skip_micro:
+        report["predict_next_dates"] = run_microbenchmarks()
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
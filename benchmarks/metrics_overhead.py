@@ -0,0 +1,100 @@
+"""
+Cost of the Prometheus instrumentation in app/metrics.py, to check it is cheap enough to leave on:
+a bare histogram observation, the observe_storage decorator around a no-op (sync and async),
+and MetricsMiddleware around a minimal ASGI app, each against the uninstrumented baseline.
+Prints microseconds per call as JSON.
+
+Usage: python benchmarks/metrics_overhead.py [--number 200000]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import timeit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app.metrics import STORAGE_LATENCY, MetricsMiddleware, observe_storage  # noqa: E402
+
+
+def _us(seconds: float, number: int) -> float:
+    return round(seconds / number * 1e6, 3)
+
+
+def bench_sync(number: int) -> dict:
+    def noop():
+        return None
+
+    instrumented = observe_storage("benchmark_sync")(noop)
+    observe = STORAGE_LATENCY.labels("benchmark_observe").observe
+    baseline = _us(timeit.timeit(noop, number=number), number)
+    wrapped = _us(timeit.timeit(instrumented, number=number), number)
+    return {
+        "histogram_observe_us": _us(timeit.timeit(lambda: observe(0.001), number=number), number),
+        "baseline_call_us": baseline,
+        "decorated_call_us": wrapped,
+        "decorator_overhead_us": round(wrapped - baseline, 3),
+    }
+
+
+async def _time_async(fn, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        await fn()
+    return time.perf_counter() - start
+
+
+async def _asgi_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def _request(app):
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app({"type": "http", "method": "GET", "path": "/bench"}, receive, send)
+
+
+async def bench_async(number: int) -> dict:
+    async def noop():
+        return None
+
+    instrumented = observe_storage("benchmark_async")(noop)
+    baseline = _us(await _time_async(noop, number), number)
+    wrapped = _us(await _time_async(instrumented, number), number)
+
+    middleware = MetricsMiddleware(_asgi_app)
+    bare_request = _us(await _time_async(lambda: _request(_asgi_app), number), number)
+    measured_request = _us(await _time_async(lambda: _request(middleware), number), number)
+    return {
+        "baseline_call_us": baseline,
+        "decorated_call_us": wrapped,
+        "decorator_overhead_us": round(wrapped - baseline, 3),
+        "asgi_request_us": bare_request,
+        "asgi_request_with_middleware_us": measured_request,
+        "middleware_overhead_us": round(measured_request - bare_request, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=200_000)
+    args = parser.parse_args()
+    report = {
+        "python": sys.version.split()[0],
+        "number": args.number,
+        "sync": bench_sync(args.number),
+        "async": asyncio.run(bench_async(args.number)),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Cold-start benchmark: import time of app.main and time to the first /predict response,
+each measured in a fresh interpreter. Prints a JSON report.
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--username alice] [--max-import-seconds 1.0]
+
+--username needs Firestore credentials (FIREBASE_KEY_JSON) and an existing user, or
+STORAGE_FLAGS_JSON='{"backend": "sqlite"}' to measure against an empty local database.
+Exits with status 1 when the median import time exceeds --max-import-seconds.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must stay off the import path of app.main
+HEAVY_MODULES = ["pandas", "google.cloud.firestore", "grpc", "apscheduler"]
+
+IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - t0
+print(json.dumps({"import_seconds": elapsed, "heavy_modules": [m for m in %r if m in sys.modules]}))
+"""
+
+FIRST_PREDICT_PROBE = """
+import json, time
+t0 = time.perf_counter()
+import app.main
+from fastapi.testclient import TestClient
+imported = time.perf_counter()
+with TestClient(app.main.app) as client:
+    token = app.main.sessions.issue(%(username)r)["access_token"]
+    response = client.get("/predict/%(username)s", headers={"Authorization": "Bearer " + token})
+done = time.perf_counter()
+print(json.dumps({"import_seconds": imported - t0, "first_predict_seconds": done - t0,
+                  "status_code": response.status_code}))
+"""
+
+
+def _run_probe(code: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("SCHEDULER_FLAGS_JSON", json.dumps({"enable_scheduler": False}))
+    proc = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--username", help="User to call /predict for (uses the configured storage backend).")
+    parser.add_argument("--max-import-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    imports = [_run_probe(IMPORT_PROBE % HEAVY_MODULES) for _ in range(args.runs)]
+    seconds = [r["import_seconds"] for r in imports]
+    report = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "import_seconds": {"min": min(seconds), "median": statistics.median(seconds), "max": max(seconds)},
+        "heavy_modules_loaded": imports[-1]["heavy_modules"],
+    }
+    if args.username:
+        report["first_predict"] = _run_probe(FIRST_PREDICT_PROBE % {"username": args.username})
+    print(json.dumps(report, indent=2))
+
+    if args.max_import_seconds is not None and report["import_seconds"]["median"] > args.max_import_seconds:
+        print(f"Median import time {report['import_seconds']['median']:.3f}s exceeds "
+              f"{args.max_import_seconds:.3f}s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()